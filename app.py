@@ -1,33 +1,228 @@
-from flask import Flask, render_template, jsonify, request
+import os
+
+# "threading" (default): one OS thread per connection and background task.
+# "eventlet": socket traffic, REST requests and network I/O run on green threads, so hundreds of
+# dashboard connections share one OS thread. Must be patched in before anything else is imported.
+ASYNC_MODE = os.environ.get("ASYNC_MODE", "threading")
+if ASYNC_MODE == "eventlet":
+    import eventlet
+    eventlet.monkey_patch()
+    from eventlet import tpool
+
+from flask import Flask, Response, render_template, jsonify, request
 from flask_socketio import SocketIO, emit
 import yt_dlp
 import threading
-import os
 import webbrowser
 import socket
 import time
 import uuid
-from urllib.parse import urlparse
+import base64
+import queue
+import atexit
+import random
+import itertools
+import heapq
+from contextlib import contextmanager
+from concurrent.futures import Future, ThreadPoolExecutor, as_completed
+from urllib.parse import urlparse, urlunparse, parse_qsl, urlencode
 import requests
+from requests.adapters import HTTPAdapter
 from datetime import datetime
 import sqlite3
 import json
 import re
+import csv
+import io
+import zlib
+import hashlib
+import hmac
+import shutil
+import subprocess
+import copy
+from collections import OrderedDict
 
 app = Flask(__name__)
 app.config["SECRET_KEY"] = "youtube-downloader-secret-2026"
-socketio = SocketIO(app, cors_allowed_origins="*", async_mode='threading')
+socketio = SocketIO(app, cors_allowed_origins="*", async_mode=ASYNC_MODE)
 
 # ================== SETUP ==================
 DOWNLOAD_DIR = "downloads"
 DB_PATH = "downloads.db"
+MAX_CONCURRENT_DOWNLOADS = 3   # Number of queue items downloaded at the same time
+MAX_DOWNLOADS_PER_DOMAIN = 2   # Max simultaneous downloads from one domain (avoid platform throttling)
+PROGRESS_FLUSH_HZ = 4          # Progress batches pushed to clients per second (in total, not per item)
+DNS_CACHE_TTL = 300            # Seconds a resolved domain stays in the DNS cache
+DNS_RESOLVER_WORKERS = 8       # Parallel background DNS lookups
+HTTP_POOL_HOSTS = 16           # Hosts whose keep-alive connections are kept in the shared HTTP session
+HTTP_POOL_PER_HOST = 4         # Max simultaneous connections to one host (extra requests wait for a free one)
+HTTP_CHECK_WORKERS = 4         # Background thumbnail checks
+DB_POOL_SIZE = 4               # Pooled SQLite connections shared by request handlers and workers
+DB_WRITE_BATCH = 200           # Max queued writes committed in one transaction
+HISTORY_PAGE_SIZE = 100        # Default number of history rows per page
+HISTORY_MAX_PAGE_SIZE = 500
+EXPORT_CHUNK_SIZE = 500        # Rows fetched and serialized per chunk when streaming an export
+METADATA_CACHE_TTL = 1800      # Seconds extracted video info is reused (format URLs expire after a few hours)
+METADATA_CACHE_SIZE = 500      # Video infos kept in memory (least recently used are evicted)
+METADATA_CACHE_PERSIST = True  # Also keep video infos in SQLite so they survive a restart
+PREVIEW_WORKERS = 4            # Max concurrent yt-dlp extractions for previews
+INFO_BATCH_MAX_URLS = 200      # URLs accepted by one batch preview request
+RESUME_QUEUE_ON_START = True   # Restart downloads that were pending/interrupted when the server stopped
+MAX_DOWNLOAD_ATTEMPTS = 4      # First try + retries for transient errors (timeouts, 5xx, 429)
+RETRY_BASE_DELAY = 5           # Seconds before the first retry, doubled on every attempt
+RETRY_MAX_DELAY = 300          # Upper bound for the backoff delay
+DOMAIN_COOLDOWN = 60           # Seconds a domain is paused after it throttles us (429)
+DOMAIN_REQUEST_RATE = 1.0      # Extractions/download starts per second per domain (0 = unlimited)
+DOMAIN_REQUEST_BURST = 5       # Requests allowed back-to-back before the rate applies
+DOMAIN_RATE_OVERRIDES = {}     # Per platform, e.g. {"tiktok.com": {"rate": 0.2, "burst": 1}}
+BANDWIDTH_LIMIT = 0            # Bytes/s shared by all downloads (0 = unlimited)
+PER_DOWNLOAD_RATE_LIMIT = 0    # Default yt-dlp ratelimit for each download in bytes/s (0 = unlimited)
+PRIORITY_LEVELS = {"low": -1, "normal": 0, "high": 1, "urgent": 2}  # Higher runs first
+PLAYLIST_MAX_ENTRIES = 1000    # Entries taken from one playlist/channel
+PLAYLIST_INTAKE_BATCH = 20     # Entries queued together while a playlist is being enumerated
+PLAYLIST_INTAKE_WORKERS = 2    # Playlists enumerated at the same time
+PLAYLIST_MAX_DEPTH = 3         # Nested playlists followed (e.g. channel -> Videos/Shorts tabs)
+FRAGMENT_CONCURRENCY = 4       # Parallel HLS/DASH fragments per download before any throughput is measured
+MAX_FRAGMENT_CONCURRENCY = 8
+TOTAL_FRAGMENT_CONNECTIONS = 16  # Fragment connections shared by all running downloads
+SLOW_CONNECTION_SPEED = 2 * 1024 * 1024  # Bytes/s below which a domain gets more fragment connections
+HTTP_CHUNK_SIZE = 10 * 1024 * 1024       # Range request size before any throughput is measured
+POSTPROCESS_WORKERS = max(1, (os.cpu_count() or 2) // 2)  # Concurrent FFmpeg jobs (each one is multi-threaded)
+DEDUPE_DOWNLOADS = True        # Reuse files already downloaded (same video, format, quality) and hardlink identical ones
+THUMBNAIL_CACHE_DIR = "thumbnail_cache"
+THUMBNAIL_CACHE_SIZE = 100 * 1024 * 1024  # Bytes of resized thumbnails kept on disk (least recently served are evicted)
+THUMBNAIL_WIDTH = 320          # Thumbnails are downscaled to this width
+THUMBNAIL_MAX_SOURCE = 10 * 1024 * 1024   # Larger remote images are not proxied
+THUMBNAIL_MAX_AGE = 7 * 86400  # Seconds browsers may reuse a thumbnail without asking again
 os.makedirs(DOWNLOAD_DIR, exist_ok=True)
+os.makedirs(THUMBNAIL_CACHE_DIR, exist_ok=True)
 
 # ================== DATABASE SETUP ==================
+db_pool = queue.LifoQueue()
+db_pool_created = 0
+db_pool_lock = threading.Lock()
+
+def connect_db():
+    """Open a SQLite connection in WAL mode so readers never wait for the writer"""
+    conn = sqlite3.connect(DB_PATH, timeout=10, check_same_thread=False)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")   # Safe with WAL, avoids an fsync per commit
+    conn.execute("PRAGMA busy_timeout=5000")
+    conn.execute("PRAGMA temp_store=MEMORY")
+    conn.execute("PRAGMA cache_size=-16000")    # 16 MB page cache
+    return conn
+
+@contextmanager
+def get_db():
+    """Borrow a pooled connection; commits on success and rolls back on error"""
+    global db_pool_created
+    try:
+        conn = db_pool.get_nowait()
+    except queue.Empty:
+        with db_pool_lock:
+            can_create = db_pool_created < DB_POOL_SIZE
+            if can_create:
+                db_pool_created += 1
+        conn = connect_db() if can_create else db_pool.get()
+    try:
+        with conn:
+            yield conn
+    finally:
+        db_pool.put(conn)
+
+def add_missing_column(table, column, definition):
+    """Migration step adding a column that databases created by older versions may already have"""
+    def step(conn):
+        columns = {row[1] for row in conn.execute(f"PRAGMA table_info({table})")}
+        if column not in columns:
+            conn.execute(f"ALTER TABLE {table} ADD COLUMN {column} {definition}")
+    return step
+
+# Each entry upgrades the schema by one version (tracked in PRAGMA user_version)
+# Steps are SQL statements or callables taking the connection
+SCHEMA_MIGRATIONS = [
+    # 1: indexes for history listing, keyset pagination and filters
+    [
+        "CREATE INDEX IF NOT EXISTS idx_downloads_date ON downloads(download_date DESC, id DESC)",
+        "CREATE INDEX IF NOT EXISTS idx_downloads_status ON downloads(status, download_date DESC, id DESC)",
+        "CREATE INDEX IF NOT EXISTS idx_downloads_platform ON downloads(platform, download_date DESC, id DESC)",
+    ],
+    # 2: full-text search over title/url/platform, kept in sync by triggers
+    [
+        '''CREATE VIRTUAL TABLE IF NOT EXISTS downloads_fts USING fts5(
+               title, url, platform,
+               content='downloads', content_rowid='id',
+               tokenize='unicode61 remove_diacritics 2')''',
+        '''CREATE TRIGGER IF NOT EXISTS downloads_fts_insert AFTER INSERT ON downloads BEGIN
+               INSERT INTO downloads_fts(rowid, title, url, platform)
+               VALUES (new.id, new.title, new.url, new.platform);
+           END''',
+        '''CREATE TRIGGER IF NOT EXISTS downloads_fts_delete AFTER DELETE ON downloads BEGIN
+               INSERT INTO downloads_fts(downloads_fts, rowid, title, url, platform)
+               VALUES ('delete', old.id, old.title, old.url, old.platform);
+           END''',
+        '''CREATE TRIGGER IF NOT EXISTS downloads_fts_update AFTER UPDATE OF title, url, platform ON downloads BEGIN
+               INSERT INTO downloads_fts(downloads_fts, rowid, title, url, platform)
+               VALUES ('delete', old.id, old.title, old.url, old.platform);
+               INSERT INTO downloads_fts(rowid, title, url, platform)
+               VALUES (new.id, new.title, new.url, new.platform);
+           END''',
+        # Index rows that existed before this migration
+        "INSERT INTO downloads_fts(downloads_fts) VALUES ('rebuild')",
+    ],
+    # 3: persistent tier of the video metadata cache
+    [
+        '''CREATE TABLE IF NOT EXISTS metadata_cache
+               (url_key TEXT PRIMARY KEY,
+                info TEXT,
+                expires_at REAL)''',
+    ],
+    # 4: download queue survives restarts
+    [
+        '''CREATE TABLE IF NOT EXISTS queue_items
+               (id TEXT PRIMARY KEY,
+                position REAL,
+                status TEXT,
+                data TEXT,
+                updated_at REAL)''',
+        "CREATE INDEX IF NOT EXISTS idx_queue_items_position ON queue_items(position)",
+    ],
+    # 5: number of attempts a download took
+    [
+        "ALTER TABLE downloads ADD COLUMN attempts INTEGER DEFAULT 1",
+    ],
+    # 6: playlist intake skips URLs that were already downloaded
+    [
+        "CREATE INDEX IF NOT EXISTS idx_downloads_url ON downloads(url)",
+    ],
+    # 7: files on disk by video and by content, for deduplication
+    [
+        '''CREATE TABLE IF NOT EXISTS downloaded_files
+               (extractor TEXT,
+                video_id TEXT,
+                format TEXT,
+                quality TEXT,
+                filepath TEXT,
+                file_size INTEGER,
+                sha256 TEXT,
+                created_at REAL,
+                PRIMARY KEY (extractor, video_id, format, quality))''',
+        "CREATE INDEX IF NOT EXISTS idx_downloaded_files_sha256 ON downloaded_files(sha256)",
+    ],
+    # 8: real output path and transfer speed of each download
+    [
+        "ALTER TABLE downloads ADD COLUMN filepath TEXT",
+        "ALTER TABLE downloads ADD COLUMN throughput REAL",
+    ],
+    # 9: thumbnail shown in the history
+    [
+        add_missing_column("downloads", "thumbnail", "TEXT"),
+    ],
+]
+
 def init_db():
-    conn = sqlite3.connect(DB_PATH)
-    c = conn.cursor()
-    c.execute('''CREATE TABLE IF NOT EXISTS downloads
+    with get_db() as conn:
+        conn.execute('''CREATE TABLE IF NOT EXISTS downloads
                  (id INTEGER PRIMARY KEY AUTOINCREMENT,
                   title TEXT,
                   url TEXT,
@@ -39,11 +234,67 @@ def init_db():
                   status TEXT,
                   download_date TIMESTAMP,
                   error_msg TEXT)''')
-    conn.commit()
-    conn.close()
+        
+        version = conn.execute("PRAGMA user_version").fetchone()[0]
+        for number, statements in enumerate(SCHEMA_MIGRATIONS[version:], start=version + 1):
+            for sql in statements:
+                if callable(sql):
+                    sql(conn)
+                else:
+                    conn.execute(sql)
+            conn.execute(f"PRAGMA user_version = {number}")
+            print(f"[DB] Migrated schema to version {number}")
 
 init_db()
 
+# ================== DATABASE WRITER ==================
+db_write_queue = queue.Queue()
+
+def db_write(sql, params=()):
+    """Queue a write for the background writer (group-committed with other pending writes)"""
+    db_write_queue.put((sql, params))
+
+def db_writer():
+    """
+    Single writer thread: takes every write that piled up while the previous
+    transaction was committing and commits them together.
+    """
+    while True:
+        batch = [db_write_queue.get()]
+        while len(batch) < DB_WRITE_BATCH:
+            try:
+                batch.append(db_write_queue.get_nowait())
+            except queue.Empty:
+                break
+        
+        stop = None in batch
+        writes = [write for write in batch if write is not None]
+        if writes:
+            try:
+                with get_db() as conn:
+                    for sql, params in writes:
+                        conn.execute(sql, params)
+            except Exception as e:
+                safe_print(f"[DB] Error writing batch of {len(writes)}: {e}, retrying one by one")
+                # The batch was rolled back: commit the writes separately so only the bad one is lost
+                for sql, params in writes:
+                    try:
+                        with get_db() as conn:
+                            conn.execute(sql, params)
+                    except Exception as e:
+                        safe_print(f"[DB] Dropped write: {e}")
+        if stop:
+            break
+
+db_writer_thread = threading.Thread(target=db_writer, daemon=True)
+db_writer_thread.start()
+
+@atexit.register
+def flush_db_writes():
+    """Commit pending writes before the process exits"""
+    db_write_queue.put(None)
+    db_writer_thread.join(timeout=5)
+
 # ================== HELPER FUNCTIONS ==================
 def get_file_size(filepath):
     """Get file size in bytes"""
@@ -62,19 +313,26 @@ def format_file_size(bytes):
         bytes /= 1024.0
     return f"{bytes:.2f} TB"
 
+def run_blocking(func, *args, **kwargs):
+    """
+    Run work that would stall the event loop (yt-dlp extraction, FFmpeg, hashing).
+    In eventlet mode it goes to a pool of real OS threads, so func must not emit or take shared locks.
+    """
+    if ASYNC_MODE == "eventlet":
+        return tpool.execute(func, *args, **kwargs)
+    return func(*args, **kwargs)
+
 def save_to_db(data):
-    """Save download record to database"""
-    try:
-        conn = sqlite3.connect(DB_PATH)
-        c = conn.cursor()
-        c.execute('''INSERT INTO downloads 
-                     (title, url, platform, format, file_size, duration, filename, status, download_date, error_msg)
-                     VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)''',
-                  (data.get('title'), data.get('url'), data.get('platform'), data.get('format'),
-                   data.get('file_size'), data.get('duration'),
-                   data.get('filename'), data.get('status'), datetime.now(), data.get('error_msg')))
-        conn.commit()
-        conn.close()
+    """Save download record to database (queued for the batched writer)"""
+    try:
+        db_write('''INSERT INTO downloads 
+                    (title, url, platform, format, file_size, duration, filename, status, download_date, error_msg,
+                     attempts, filepath, throughput, thumbnail)
+                    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)''',
+                 (data.get('title'), data.get('url'), data.get('platform'), data.get('format'),
+                  data.get('file_size'), data.get('duration'),
+                  data.get('filename'), data.get('status'), datetime.now(), data.get('error_msg'),
+                  data.get('attempts', 1), data.get('filepath'), data.get('throughput'), data.get('thumbnail')))
     except Exception as e:
         safe_print(f"[DB] Error saving to database: {e}")
 
@@ -96,10 +354,248 @@ def get_platform_icon(platform):
             return icon
     return '🌐'
 
+# ================== QUEUE STORE ==================
+class DownloadQueue:
+    """
+    In-memory download queue indexed by id, URL and status.
+    Lookup, duplicate check, status change and removal are all O(1);
+    items keep their insertion order.
+
+    Every mutation bumps a sequence number and is reported to `on_change(event, payload)`
+    as an item_added / item_changed / item_removed delta (called while holding the lock,
+    so listeners see changes in sequence order).
+    """
+
+    def __init__(self, on_change=None):
+        self.lock = threading.RLock()
+        self.seq = 0
+        self.on_change = on_change
+        self._items = {}      # id -> item {id, url, format, status, title, progress, ip, domain, protocol}
+        self._urls = {}       # url -> id
+        self._by_status = {}  # status -> {id: None} (ordered set)
+
+    def _notify(self, event, payload):
+        self.seq += 1
+        if self.on_change:
+            payload["seq"] = self.seq
+            self.on_change(event, payload)
+
+    def __len__(self):
+        return len(self._items)
+
+    def snapshot(self):
+        """Copy of all items in queue order (safe to serialize outside the lock)"""
+        with self.lock:
+            return [dict(item) for item in self._items.values()]
+
+    def state(self):
+        """Full snapshot together with the sequence number it corresponds to"""
+        with self.lock:
+            return {"seq": self.seq, "queue": self.snapshot()}
+
+    def get(self, item_id):
+        return self._items.get(item_id)
+
+    def has_url(self, url):
+        return url in self._urls
+
+    def count(self, status):
+        return len(self._by_status.get(status, ()))
+
+    def with_status(self, status):
+        """Items with the given status in queue order (caller holds the lock while iterating)"""
+        return [self._items[item_id] for item_id in self._by_status.get(status, ())]
+
+    def add(self, item):
+        """Add an item, returns False if its URL is already queued"""
+        with self.lock:
+            if item["url"] in self._urls:
+                return False
+            self._items[item["id"]] = item
+            self._urls[item["url"]] = item["id"]
+            self._by_status.setdefault(item["status"], {})[item["id"]] = None
+            self._notify("item_added", {"item": dict(item)})
+            return True
+
+    def update(self, item_id, **fields):
+        """Update item fields (keeping the status index in sync), returns the item or None"""
+        with self.lock:
+            item = self._items.get(item_id)
+            if item is None:
+                return None
+            changes = {key: value for key, value in fields.items() if item.get(key) != value}
+            if not changes:
+                return item
+            new_status = changes.get("status")
+            if new_status:
+                self._by_status[item["status"]].pop(item_id, None)
+                self._by_status.setdefault(new_status, {})[item_id] = None
+            item.update(changes)
+            self._notify("item_changed", {"id": item_id, "changes": changes})
+            return item
+
+    def set_progress(self, item_id, **fields):
+        """Update transient progress fields of a downloading item without emitting a delta
+        (progress reaches clients through ProgressAggregator batches instead)"""
+        with self.lock:
+            item = self._items.get(item_id)
+            if item is not None and item["status"] == "downloading":
+                item.update(fields)
+
+    def remove(self, item_id, statuses=None):
+        """Remove an item (only if its status is in `statuses` when given), returns it or None"""
+        with self.lock:
+            item = self._items.get(item_id)
+            if item is None or (statuses is not None and item["status"] not in statuses):
+                return None
+            del self._items[item_id]
+            self._urls.pop(item["url"], None)
+            self._by_status[item["status"]].pop(item_id, None)
+            self._notify("item_removed", {"id": item_id})
+            return item
+
+    def clear(self, keep_statuses=()):
+        """Remove every item except those whose status is in `keep_statuses`"""
+        with self.lock:
+            removed = [item_id for item_id, item in self._items.items() if item["status"] not in keep_statuses]
+            for item_id in removed:
+                self.remove(item_id)
+            return removed
+
 # ================== QUEUE STATE ==================
-download_queue = []  # List of {id, url, format, status, title, progress, ip, protocol, headers}
+def broadcast_queue_change(event, payload):
+    """Push a queue delta to all clients (clients resync on a sequence gap)"""
+    socketio.emit(event, payload)
+
+def persist_queue_change(event, payload):
+    """Mirror a queue delta into the queue_items table (through the batched writer, in sequence order)"""
+    now = time.time()
+    if event == "item_added":
+        item = payload["item"]
+        db_write("INSERT OR REPLACE INTO queue_items (id, position, status, data, updated_at) VALUES (?, ?, ?, ?, ?)",
+                 (item["id"], now, item["status"], json.dumps(item), now))
+    elif event == "item_changed":
+        item = download_queue.get(payload["id"])
+        db_write("UPDATE queue_items SET status = ?, data = ?, updated_at = ? WHERE id = ?",
+                 (item["status"], json.dumps(item), now, item["id"]))
+    elif event == "item_removed":
+        db_write("DELETE FROM queue_items WHERE id = ?", (payload["id"],))
+
+def on_queue_change(event, payload):
+    pending_index.on_change(event, payload)
+    broadcast_queue_change(event, payload)
+    persist_queue_change(event, payload)
+
+download_queue = DownloadQueue(on_change=on_queue_change)
 is_downloading = False
-queue_lock = threading.Lock()
+queue_lock = download_queue.lock
+queue_cond = threading.Condition(queue_lock)  # Wakes idle workers when items are added or a slot frees up
+active_workers = 0
+active_domains = {}  # domain -> number of items currently downloading
+domain_cooldowns = {}  # domain -> time.time() until which it gets no new downloads
+client_served = {}  # client -> time.monotonic() of its last download start (round-robin between clients)
+active_intakes = 0  # Playlists still being enumerated - workers wait for their entries instead of exiting
+active_postprocess = 0  # Downloads waiting for or running FFmpeg in the post-processing pool
+
+def restore_queue():
+    """
+    Reload the queue saved before the last shutdown. Interrupted downloads go back to
+    pending and resume from their .part files; finished items are dropped.
+    """
+    with get_db() as conn:
+        rows = conn.execute("SELECT id, status, data FROM queue_items ORDER BY position, rowid").fetchall()
+    
+    restored = resumed = 0
+    for item_id, status, data in rows:
+        if status in ("completed", "error"):
+            # Already recorded in history, it was only waiting for auto-removal
+            db_write("DELETE FROM queue_items WHERE id = ?", (item_id,))
+            continue
+        
+        item = json.loads(data)
+        if status in ("downloading", "processing"):
+            item.update(status="pending", resumed=True)
+            resumed += 1
+        item["progress"] = ""
+        
+        # Re-adding rewrites the row; restored items are inserted in their saved order
+        if download_queue.add(item):
+            restored += 1
+    
+    if restored:
+        safe_print(f"[QUEUE] Restored {restored} items ({resumed} interrupted downloads will resume)")
+
+# ================== PROGRESS AGGREGATOR ==================
+class ProgressAggregator:
+    """
+    Collects yt-dlp progress ticks and keeps only the latest state per item.
+    A single background task flushes everything that changed as one `progress_batch`
+    event every 1/flush_hz seconds; intermediate values are dropped.
+    Speed is a moving average of downloaded_bytes over time, ETA is derived from it.
+    """
+    SPEED_WINDOW = 0.5     # Seconds between speed samples
+    SPEED_SMOOTHING = 0.3  # Weight of the newest sample in the moving average
+
+    def __init__(self, flush_hz):
+        self.interval = 1.0 / flush_hz
+        self.lock = threading.Lock()
+        self._latest = {}  # item_id -> {progress, downloaded_bytes, total_bytes, speed, eta}
+        self._speed = {}   # item_id -> [window_start, bytes_at_window_start, smoothed_speed]
+        self._dirty = set()
+
+    def update(self, item_id, downloaded_bytes, total_bytes):
+        now = time.monotonic()
+        with self.lock:
+            window = self._speed.get(item_id)
+            if window is None or downloaded_bytes < window[1]:
+                window = self._speed[item_id] = [now, downloaded_bytes, 0.0]
+            elif now - window[0] >= self.SPEED_WINDOW:
+                sample = (downloaded_bytes - window[1]) / (now - window[0])
+                window[2] = sample if not window[2] else self.SPEED_SMOOTHING * sample + (1 - self.SPEED_SMOOTHING) * window[2]
+                window[0], window[1] = now, downloaded_bytes
+            
+            speed = window[2]
+            if total_bytes > 0:
+                progress = f"{downloaded_bytes / total_bytes * 100:.1f}%"
+            else:
+                progress = format_file_size(downloaded_bytes)
+            
+            self._latest[item_id] = {
+                "progress": progress,
+                "downloaded_bytes": downloaded_bytes,
+                "total_bytes": total_bytes,
+                "speed": round(speed),
+                "eta": int((total_bytes - downloaded_bytes) / speed) if speed > 0 and total_bytes > downloaded_bytes else None
+            }
+            self._dirty.add(item_id)
+
+    def discard(self, item_id):
+        """Forget a finished item (its final state is sent as a queue delta)"""
+        with self.lock:
+            self._latest.pop(item_id, None)
+            self._speed.pop(item_id, None)
+            self._dirty.discard(item_id)
+
+    def flush(self):
+        with self.lock:
+            batch = [dict(self._latest[item_id], id=item_id) for item_id in self._dirty]
+            self._dirty.clear()
+        if not batch:
+            return
+        for entry in batch:
+            download_queue.set_progress(entry["id"], **{key: value for key, value in entry.items() if key != "id"})
+        socketio.emit("progress_batch", {"items": batch})
+
+    def run(self):
+        while True:
+            time.sleep(self.interval)
+            try:
+                self.flush()
+            except Exception as e:
+                safe_print(f"[PROGRESS] Flush error: {e}")
+
+progress_aggregator = ProgressAggregator(PROGRESS_FLUSH_HZ)
+socketio.start_background_task(progress_aggregator.run)
 
 # ================== STATISTICS ==================
 server_start_time = datetime.now()
@@ -107,8 +603,10 @@ stats = {
     "total_downloads": 0,
     "successful_downloads": 0,
     "failed_downloads": 0,
-    "total_bytes": 0,
-    "connection_count": 0
+    "total_bytes": 0,         # Bytes transferred from the network by finished downloads
+    "transfer_seconds": 0.0,  # Time those transfers took
+    "connection_count": 0,
+    "postprocess_paths": {"none": 0, "remux": 0, "transcode": 0}  # How finished files reached their format
 }
 
 # ================== ENCODING HELPER ==================
@@ -135,28 +633,93 @@ if os.name == 'nt':  # Windows only
             safe_print(f"[FFmpeg] Added to PATH: {ffmpeg_dirs[0]}")
 
 # ================== NETWORK HELPERS ==================
+dns_cache = {}     # domain -> (expires_at, ip)
+dns_inflight = {}  # domain -> Future of a lookup in progress
+dns_lock = threading.Lock()
+dns_executor = ThreadPoolExecutor(max_workers=DNS_RESOLVER_WORKERS, thread_name_prefix="dns")
+
+def parse_url_host(url):
+    """Split URL into (domain, protocol) without touching the network"""
+    parsed = urlparse(url)
+    domain = parsed.netloc or parsed.path.split('/')[0]
+    # Remove port if present
+    domain = domain.split(':')[0]
+    return domain, parsed.scheme.upper() or "HTTP"
+
+def resolve_domain(domain):
+    """
+    Resolve domain to IP in the background. Returns a Future.
+    Results are cached for DNS_CACHE_TTL seconds and concurrent lookups of
+    the same domain share a single query.
+    """
+    with dns_lock:
+        cached = dns_cache.get(domain)
+        if cached and cached[0] > time.monotonic():
+            future = Future()
+            future.set_result(cached[1])
+            return future
+        
+        future = dns_inflight.get(domain)
+        if future is not None:
+            return future
+        future = dns_executor.submit(socket.gethostbyname, domain)
+        dns_inflight[domain] = future
+    
+    # Outside the lock: a lookup that already finished runs the callback right here
+    future.add_done_callback(lambda f: _store_dns_result(domain, f))
+    return future
+
+def _store_dns_result(domain, future):
+    with dns_lock:
+        dns_inflight.pop(domain, None)
+        if not future.exception():
+            dns_cache[domain] = (time.monotonic() + DNS_CACHE_TTL, future.result())
+
 def resolve_dns(url):
     """Resolve domain name to IP address - demonstrates DNS lookup"""
     try:
-        parsed = urlparse(url)
-        domain = parsed.netloc or parsed.path.split('/')[0]
-        # Remove port if present
-        domain = domain.split(':')[0]
-        ip = socket.gethostbyname(domain)
+        domain, protocol = parse_url_host(url)
+        ip = resolve_domain(domain).result()
         return {
             "domain": domain,
             "ip": ip,
-            "protocol": parsed.scheme.upper() or "HTTP"
+            "protocol": protocol
         }
     except socket.gaierror as e:
         return {"domain": domain, "ip": "Unknown", "protocol": "Unknown", "error": str(e)}
     except Exception as e:
         return {"domain": "Unknown", "ip": "Unknown", "protocol": "Unknown", "error": str(e)}
 
+TRACKING_PARAMS = {"si", "feature", "fbclid", "igshid", "gclid", "pp"}  # Query params that never change the video
+
+def normalize_url(url):
+    """Canonical form of a video URL: lowercase host without www./m., no fragment or tracking params"""
+    parsed = urlparse(url.strip())
+    host = parsed.netloc.lower()
+    for prefix in ("www.", "m."):
+        if host.startswith(prefix):
+            host = host[len(prefix):]
+            break
+    query = sorted((key, value) for key, value in parse_qsl(parsed.query, keep_blank_values=True)
+                   if not key.startswith("utm_") and key not in TRACKING_PARAMS)
+    scheme = "https" if parsed.scheme.lower() in ("http", "https", "") else parsed.scheme.lower()
+    return urlunparse((scheme, host, parsed.path.rstrip('/') or '/', '', urlencode(query), ''))
+
+def create_http_session():
+    """Shared session: requests to a host reuse pooled keep-alive connections instead of a new TCP+TLS handshake"""
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=HTTP_POOL_HOSTS, pool_maxsize=HTTP_POOL_PER_HOST, pool_block=True)
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+http_session = create_http_session()
+http_executor = ThreadPoolExecutor(max_workers=HTTP_CHECK_WORKERS, thread_name_prefix="http")
+
 def get_url_headers(url):
     """Get HTTP response headers from URL - demonstrates HTTP protocol"""
     try:
-        response = requests.head(url, timeout=5, allow_redirects=True)
+        response = http_session.head(url, timeout=5, allow_redirects=True)
         return {
             "status_code": response.status_code,
             "headers": dict(response.headers),
@@ -170,6 +733,208 @@ def get_url_headers(url):
     except Exception as e:
         return {"error": str(e), "status_code": 0}
 
+# ================== RATE LIMITING ==================
+class TokenBucket:
+    """Tokens refill at `rate` per second up to `capacity`. A rate of 0 means unlimited."""
+    def __init__(self, rate, capacity):
+        self.lock = threading.Lock()
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+    
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+    
+    def configure(self, rate, capacity):
+        with self.lock:
+            self._refill()
+            self.rate = rate
+            self.capacity = capacity
+            self.tokens = min(self.tokens, capacity)
+    
+    def reserve(self, amount=1):
+        """Take `amount` tokens, going into debt if needed. Returns the seconds to wait before proceeding."""
+        with self.lock:
+            if self.rate <= 0:
+                return 0
+            self._refill()
+            self.tokens -= amount
+            return max(0, -self.tokens / self.rate)
+    
+    def consume(self, amount=1):
+        delay = self.reserve(amount)
+        if delay:
+            time.sleep(delay)
+        return delay
+
+class RateLimiter:
+    """Request pacing per domain plus global and per-download bandwidth caps, adjustable at runtime"""
+    def __init__(self, domain_rate, domain_burst, overrides, bandwidth, per_download):
+        self.lock = threading.Lock()
+        self.domain_rate = domain_rate
+        self.domain_burst = domain_burst
+        self.overrides = dict(overrides)
+        self.buckets = {}  # domain -> TokenBucket
+        self.bandwidth = TokenBucket(bandwidth, bandwidth)
+        self.per_download = per_download
+    
+    def _domain_limits(self, domain):
+        """(rate, burst) for domain. An override for tiktok.com also covers www.tiktok.com"""
+        for suffix, limits in self.overrides.items():
+            if domain == suffix or domain.endswith("." + suffix):
+                return limits.get("rate", self.domain_rate), limits.get("burst", self.domain_burst)
+        return self.domain_rate, self.domain_burst
+    
+    def acquire_request(self, domain):
+        """Block until the domain may receive another request. Returns the time waited."""
+        with self.lock:
+            bucket = self.buckets.get(domain)
+            if bucket is None:
+                bucket = self.buckets[domain] = TokenBucket(*self._domain_limits(domain))
+        return bucket.consume()
+    
+    def consume_bandwidth(self, nbytes):
+        """Called from progress hooks: sleeping there throttles the download thread itself"""
+        return self.bandwidth.consume(nbytes)
+    
+    def config(self):
+        with self.lock:
+            return {
+                "domain_rate": self.domain_rate,
+                "domain_burst": self.domain_burst,
+                "domains": copy.deepcopy(self.overrides),
+                "bandwidth_limit": self.bandwidth.rate,
+                "per_download_limit": self.per_download
+            }
+    
+    def update(self, changes):
+        """
+        Apply a partial config (same keys as config()). Raises ValueError on invalid values,
+        in which case nothing is changed.
+        """
+        def number(key, value):
+            if isinstance(value, bool) or not isinstance(value, (int, float)) or value < 0:
+                raise ValueError(f"{key} must be a non-negative number")
+            return value
+        
+        # Validate everything first so a bad value cannot leave the limits half-updated
+        validated = {key: number(key, changes[key])
+                     for key in ("domain_rate", "domain_burst", "per_download_limit", "bandwidth_limit")
+                     if key in changes}
+        domains = changes.get("domains") or {}
+        if not isinstance(domains, dict):
+            raise ValueError("domains must be an object")
+        overrides = {}
+        for domain, limits in domains.items():
+            if limits is None:
+                overrides[domain] = None
+            elif isinstance(limits, dict):
+                overrides[domain] = {key: number(key, limits[key]) for key in ("rate", "burst") if key in limits}
+            else:
+                raise ValueError("domains values must be objects or null")
+        
+        with self.lock:
+            if "domain_rate" in validated:
+                self.domain_rate = validated["domain_rate"]
+            if "domain_burst" in validated:
+                self.domain_burst = max(1, validated["domain_burst"])
+            for domain, limits in overrides.items():
+                if limits is None:
+                    self.overrides.pop(domain, None)
+                else:
+                    self.overrides[domain] = limits
+            if "per_download_limit" in validated:
+                self.per_download = validated["per_download_limit"]
+            if "bandwidth_limit" in validated:
+                self.bandwidth.configure(validated["bandwidth_limit"], validated["bandwidth_limit"])
+            
+            # Existing buckets keep their tokens but follow the new limits
+            for domain, bucket in self.buckets.items():
+                bucket.configure(*self._domain_limits(domain))
+        
+        return self.config()
+
+rate_limiter = RateLimiter(DOMAIN_REQUEST_RATE, DOMAIN_REQUEST_BURST, DOMAIN_RATE_OVERRIDES,
+                           BANDWIDTH_LIMIT, PER_DOWNLOAD_RATE_LIMIT)
+
+# ================== METADATA CACHE ==================
+class MetadataCache:
+    """
+    yt-dlp info dicts keyed by normalized URL, so the preview, the download and
+    retries share one extraction. In-memory LRU with TTL, optionally backed by
+    the metadata_cache table so entries survive a restart.
+    """
+    # Large fields the downloader never needs
+    DROP_FIELDS = ("automatic_captions", "subtitles", "heatmap")
+
+    def __init__(self, ttl, max_entries, persist):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.persist = persist
+        self.lock = threading.Lock()
+        self._entries = OrderedDict()  # url_key -> (expires_at, info)
+
+    def _remember(self, key, expires_at, info):
+        with self.lock:
+            self._entries[key] = (expires_at, info)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def get(self, url):
+        """Cached info for url or None. The returned dict is shared - copy before modifying"""
+        key = normalize_url(url)
+        now = time.time()
+        with self.lock:
+            entry = self._entries.get(key)
+            if entry and entry[0] > now:
+                self._entries.move_to_end(key)
+                return entry[1]
+            self._entries.pop(key, None)
+        
+        if self.persist:
+            try:
+                with get_db() as conn:
+                    row = conn.execute("SELECT info, expires_at FROM metadata_cache WHERE url_key=?", (key,)).fetchone()
+                if row and row[1] > now:
+                    info = json.loads(row[0])
+                    self._remember(key, row[1], info)
+                    return info
+            except Exception as e:
+                safe_print(f"[CACHE] Error reading metadata cache: {e}")
+        return None
+
+    def put(self, url, info):
+        """Cache extracted info (single videos only), returns the JSON-safe copy that was stored"""
+        info = yt_dlp.YoutubeDL.sanitize_info(info, remove_private_keys=True)
+        if info.get("_type", "video") != "video":
+            # Playlists are extracted differently by the downloader (noplaylist)
+            return info
+        for field in self.DROP_FIELDS:
+            info.pop(field, None)
+        
+        key = normalize_url(url)
+        expires_at = time.time() + self.ttl
+        self._remember(key, expires_at, info)
+        if self.persist:
+            db_write("INSERT OR REPLACE INTO metadata_cache (url_key, info, expires_at) VALUES (?, ?, ?)",
+                     (key, json.dumps(info), expires_at))
+        return info
+
+    def invalidate(self, url):
+        key = normalize_url(url)
+        with self.lock:
+            self._entries.pop(key, None)
+        if self.persist:
+            db_write("DELETE FROM metadata_cache WHERE url_key=?", (key,))
+
+metadata_cache = MetadataCache(METADATA_CACHE_TTL, METADATA_CACHE_SIZE, METADATA_CACHE_PERSIST)
+if METADATA_CACHE_PERSIST:
+    db_write("DELETE FROM metadata_cache WHERE expires_at < ?", (time.time(),))
+
 # ================== WEB ROUTES ==================
 @app.route("/")
 def index():
@@ -179,10 +944,12 @@ def index():
 @app.route("/api/queue", methods=["GET"])
 def api_get_queue():
     """GET /api/queue - Retrieve download queue (RESTful API)"""
+    state = download_queue.state()
     return jsonify({
         "success": True,
-        "queue": download_queue,
-        "count": len(download_queue),
+        "queue": state["queue"],
+        "seq": state["seq"],
+        "count": len(state["queue"]),
         "is_downloading": is_downloading
     })
 
@@ -196,61 +963,95 @@ def api_add_download():
     urls = data.get("urls", [])
     fmt = data.get("format", "auto")
     quality = data.get("quality", "best")
+    ratelimit = data.get("ratelimit")
+    priority = data.get("priority", "normal")
     
     if not urls:
         return jsonify({"success": False, "error": "No URLs provided"}), 400
+    try:
+        tuning = parse_tuning(data)
+    except ValueError as e:
+        return jsonify({"success": False, "error": str(e)}), 400
+    if ratelimit is not None and (isinstance(ratelimit, bool) or not isinstance(ratelimit, (int, float)) or ratelimit <= 0):
+        return jsonify({"success": False, "error": "ratelimit must be a positive number of bytes/s"}), 400
+    if priority not in PRIORITY_LEVELS:
+        return jsonify({"success": False, "error": f"priority must be one of {list(PRIORITY_LEVELS)}"}), 400
     
-    added = []
-    for url in urls:
-        url = url.strip()
-        if not url:
-            continue
-        
-        # Resolve DNS for network info
-        dns_info = resolve_dns(url)
-        
-        item = {
-            "id": str(uuid.uuid4()),
-            "url": url,
-            "format": fmt,
-            "quality": quality,
-            "status": "pending",
-            "title": None,
-            "progress": "",
-            "ip": dns_info.get("ip", "Unknown"),
-            "domain": dns_info.get("domain", "Unknown"),
-            "protocol": dns_info.get("protocol", "Unknown")
-        }
-        
-        with queue_lock:
-            download_queue.append(item)
-        added.append(item)
+    # Fairness is per client: an explicit id, otherwise the caller's address
+    client = data.get("client") or request.remote_addr
+    options = {"ratelimit": ratelimit, "priority": PRIORITY_LEVELS[priority], "client": client, "tuning": tuning}
+    
+    if data.get("playlist"):
+        # Entries arrive in the queue over time, follow them with the playlist_progress event
+        intakes = submit_playlist_intake(urls, fmt, quality, **options)
+        return jsonify({"success": True, "intakes": intakes}), 202
     
-    socketio.emit("queue_updated", {"queue": download_queue})
+    added, skipped = enqueue_urls(urls, fmt, quality, **options)
     
     return jsonify({
         "success": True,
         "added": len(added),
-        "items": added
+        "skipped": skipped,
+        "items": [dict(item) for item in added]
     })
 
-@app.route("/api/queue/<item_id>", methods=["DELETE"])
-def api_delete_queue_item(item_id):
-    """DELETE /api/queue/{id} - Remove item from queue (RESTful API)"""
-    global download_queue
+@app.route("/api/limits", methods=["GET"])
+def api_get_limits():
+    """GET /api/limits - Current request and bandwidth limits"""
+    return jsonify({"success": True, "limits": rate_limiter.config()})
+
+@app.route("/api/limits", methods=["PUT"])
+def api_update_limits():
+    """PUT /api/limits - Change limits at runtime (partial JSON, same keys as GET)"""
+    data = request.get_json(silent=True)
+    if not isinstance(data, dict):
+        return jsonify({"success": False, "error": "Invalid JSON"}), 400
     
-    with queue_lock:
-        original_len = len(download_queue)
-        download_queue = [item for item in download_queue if item["id"] != item_id]
-        removed = original_len - len(download_queue)
+    try:
+        limits = rate_limiter.update(data)
+    except ValueError as e:
+        return jsonify({"success": False, "error": str(e)}), 400
     
-    socketio.emit("queue_updated", {"queue": download_queue})
+    safe_print(f"[LIMITS] Updated: {limits}")
+    return jsonify({"success": True, "limits": limits})
+
+@app.route("/api/queue/<item_id>", methods=["DELETE"])
+def api_delete_queue_item(item_id):
+    """DELETE /api/queue/{id} - Remove item from queue (RESTful API); running downloads are kept"""
+    removed = 1 if download_queue.remove(item_id, statuses=("pending", "completed", "error")) else 0
     
     return jsonify({
         "success": removed > 0,
         "removed": removed
     })
 
+@app.route("/api/queue/<item_id>", methods=["PATCH"])
+def api_update_queue_item(item_id):
+    """PATCH /api/queue/{id} - Change the priority of a pending item"""
+    data = request.get_json(silent=True) or {}
+    priority = data.get("priority")
+    if priority not in PRIORITY_LEVELS:
+        return jsonify({"success": False, "error": f"priority must be one of {list(PRIORITY_LEVELS)}"}), 400
+    
+    updated = set_item_priority(item_id, PRIORITY_LEVELS[priority])
+    return jsonify({"success": updated}), 200 if updated else 404
+
+@app.route("/api/queue/<item_id>/front", methods=["POST"])
+def api_move_to_front(item_id):
+    """POST /api/queue/{id}/front - Download this pending item next"""
+    moved = reorder_queue([item_id])
+    return jsonify({"success": moved > 0}), 200 if moved else 404
+
+@app.route("/api/queue/reorder", methods=["POST"])
+def api_reorder_queue():
+    """POST /api/queue/reorder - Put the given pending items at the front, in this order"""
+    data = request.get_json(silent=True) or {}
+    ids = data.get("ids")
+    if not isinstance(ids, list) or not ids:
+        return jsonify({"success": False, "error": "ids must be a non-empty list"}), 400
+    
+    return jsonify({"success": True, "moved": reorder_queue(ids)})
+
 @app.route("/api/status", methods=["GET"])
 def api_status():
     """GET /api/status - Server status and statistics (RESTful API)"""
@@ -264,12 +1065,66 @@ def api_status():
             "start_time": server_start_time.isoformat()
         },
         "stats": stats,
+        "throughput": throughput_metrics(),
         "queue": {
             "count": len(download_queue),
             "is_downloading": is_downloading
         }
     })
 
+def throughput_metrics():
+    """Live and historical transfer rates in bytes/s"""
+    with queue_lock:
+        current = sum(item.get("speed") or 0 for item in download_queue.with_status("downloading"))
+        average = stats["total_bytes"] / stats["transfer_seconds"] if stats["transfer_seconds"] else None
+    with throughput_lock:
+        per_domain = dict(domain_throughput)
+    return {
+        "current_bytes_per_second": current,
+        "average_bytes_per_second": average,  # Over all finished transfers since start
+        "per_domain": per_domain  # Moving average per domain, also used to tune new downloads
+    }
+
+@app.route("/api/info/batch", methods=["POST"])
+def api_info_batch():
+    """
+    POST /api/info/batch - Video info for many URLs: {"urls": [...]}.
+    Streams one JSON line per URL as soon as it is extracted (completion order, `index` = position in urls)
+    """
+    data = request.get_json(silent=True) or {}
+    urls = data.get("urls")
+    
+    if not isinstance(urls, list) or not urls:
+        return jsonify({"success": False, "error": "No URLs provided"}), 400
+    if len(urls) > INFO_BATCH_MAX_URLS:
+        return jsonify({"success": False, "error": f"At most {INFO_BATCH_MAX_URLS} URLs per request"}), 400
+    
+    return Response(stream_info_batch([str(url).strip() for url in urls]), mimetype="application/x-ndjson")
+
+@app.route("/api/thumbnail/<key>")
+def api_thumbnail(key):
+    """GET /api/thumbnail/<key> - Downscaled thumbnail served from the local cache (keys come from preview/history)"""
+    url = thumbnail_url_from_key(key)
+    if not url:
+        return jsonify({"success": False, "error": "Invalid thumbnail key"}), 404
+    
+    path = cached_thumbnail(url)
+    if not path:
+        return jsonify({"success": False, "error": "Thumbnail unavailable"}), 502
+    
+    try:
+        with open(path, "rb") as f:
+            data = f.read()
+    except FileNotFoundError:
+        # Evicted between the lookup and the read
+        return jsonify({"success": False, "error": "Thumbnail unavailable"}), 502
+    
+    response = Response(data, mimetype=image_mimetype(data))
+    response.set_etag(hashlib.sha256(data).hexdigest()[:32])
+    response.cache_control.public = True
+    response.cache_control.max_age = THUMBNAIL_MAX_AGE
+    return response.make_conditional(request)
+
 @app.route("/api/info", methods=["POST"])
 def api_url_info():
     """POST /api/info - Get network info for URL (DNS, headers)"""
@@ -289,71 +1144,133 @@ def api_url_info():
         "http": headers_info
     })
 
+HISTORY_COLUMNS = '''downloads.id, downloads.title, downloads.url, downloads.platform, downloads.format,
+                     downloads.file_size, downloads.duration, downloads.filename, downloads.status,
+                     downloads.download_date, downloads.error_msg, downloads.attempts, downloads.throughput,
+                     downloads.thumbnail'''
+
+def history_row_to_dict(row):
+    """Convert a row selected with HISTORY_COLUMNS to the JSON shape used by the frontend"""
+    return {
+        'id': row[0],
+        'title': row[1],
+        'url': row[2],
+        'platform': row[3],
+        'platform_icon': get_platform_icon(row[3]),
+        'format': row[4],
+        'file_size': format_file_size(row[5]) if row[5] else 'N/A',
+        'duration': row[6],
+        'filename': row[7],
+        'status': row[8],
+        'download_date': row[9],
+        'error_msg': row[10],
+        'attempts': row[11] or 1,
+        'throughput': row[12],  # Bytes/s of the transfer, None if nothing was downloaded
+        'thumbnail': thumbnail_proxy_url(row[13])
+    }
+
+def parse_date_arg(value, end_of_day=False):
+    """Parse a YYYY-MM-DD / ISO date query argument into the stored timestamp format"""
+    parsed = datetime.fromisoformat(value)
+    if end_of_day and len(value) == 10:
+        # Plain date as upper bound includes the whole day
+        parsed = parsed.replace(hour=23, minute=59, second=59, microsecond=999999)
+    return str(parsed)
+
+def history_filters(args):
+    """Build WHERE conditions from status/platform/format/date_from/date_to query args"""
+    conditions, params = [], []
+    for column in ('status', 'platform', 'format'):
+        if args.get(column):
+            conditions.append(f"downloads.{column} = ?")
+            params.append(args[column])
+    if args.get('date_from'):
+        conditions.append("downloads.download_date >= ?")
+        params.append(parse_date_arg(args['date_from']))
+    if args.get('date_to'):
+        conditions.append("downloads.download_date <= ?")
+        params.append(parse_date_arg(args['date_to'], end_of_day=True))
+    return conditions, params
+
+def encode_cursor(row):
+    """Opaque keyset cursor pointing after the given row (download_date, id)"""
+    return base64.urlsafe_b64encode(json.dumps([row[9], row[0]]).encode()).decode()
+
+def decode_cursor(cursor):
+    return json.loads(base64.urlsafe_b64decode(cursor.encode()))
+
 @app.route("/api/history")
 def get_history():
-    """Get download history"""
+    """
+    GET /api/history - Download history, newest first.
+    Query: limit, cursor (from next_cursor), status, platform, format, date_from, date_to
+    """
     try:
-        conn = sqlite3.connect(DB_PATH)
-        c = conn.cursor()
-        c.execute('''SELECT id, title, url, platform, format, file_size, duration, 
-                     filename, status, download_date, error_msg 
-                     FROM downloads ORDER BY download_date DESC LIMIT 100''')
+        limit = min(max(int(request.args.get('limit', HISTORY_PAGE_SIZE)), 1), HISTORY_MAX_PAGE_SIZE)
+        conditions, params = history_filters(request.args)
         
-        rows = c.fetchall()
-        conn.close()
+        cursor = request.args.get('cursor')
+        if cursor:
+            # Keyset pagination: continue right after the last row of the previous page
+            last_date, last_id = decode_cursor(cursor)
+            conditions.append("(download_date, id) < (?, ?)")
+            params.extend([last_date, last_id])
+    except (ValueError, TypeError) as e:
+        return jsonify({'success': False, 'error': f"Invalid parameter: {e}"}), 400
+    
+    try:
+        where = f"WHERE {' AND '.join(conditions)}" if conditions else ""
+        with get_db() as conn:
+            rows = conn.execute(f'''SELECT {HISTORY_COLUMNS}
+                                    FROM downloads {where}
+                                    ORDER BY download_date DESC, id DESC LIMIT ?''',
+                                params + [limit + 1]).fetchall()
         
-        history = []
-        for row in rows:
-            history.append({
-                'id': row[0],
-                'title': row[1],
-                'url': row[2],
-                'platform': row[3],
-                'platform_icon': get_platform_icon(row[3]),
-                'format': row[4],
-                'file_size': format_file_size(row[5]) if row[5] else 'N/A',
-                'duration': row[6],
-                'filename': row[7],
-                'status': row[8],
-                'download_date': row[9],
-                'error_msg': row[10]
-            })
+        has_more = len(rows) > limit
+        rows = rows[:limit]
         
-        return jsonify(history)
+        return jsonify({
+            'success': True,
+            'history': [history_row_to_dict(row) for row in rows],
+            'next_cursor': encode_cursor(rows[-1]) if has_more else None
+        })
     except Exception as e:
-        return jsonify([])
+        safe_print(f"[DB] Error loading history: {e}")
+        return jsonify({'success': False, 'history': [], 'next_cursor': None})
 
 @app.route("/api/delete/<int:id>", methods=['DELETE'])
 @app.route("/api/delete/<int:id>", methods=['DELETE'])
 def delete_record(id):
     """Delete a download record and the actual file"""
     try:
-        conn = sqlite3.connect(DB_PATH)
-        c = conn.cursor()
-        
-        # 1. Lấy tên file trước khi xóa record
-        c.execute("SELECT filename FROM downloads WHERE id=?", (id,))
-        row = c.fetchone()
-        
-        if row and row[0]:
-            filename = row[0]
-            # Tạo đường dẫn file đầy đủ
-            file_path = os.path.join(DOWNLOAD_DIR, filename)
+        with get_db() as conn:
+            # 1. Lấy tên file trước khi xóa record
+            row = conn.execute("SELECT filename, filepath FROM downloads WHERE id=?", (id,)).fetchone()
             
-            # Xóa file nếu tồn tại
-            if os.path.exists(file_path):
-                try:
-                    os.remove(file_path)
-                    safe_print(f"[FILE] Deleted physical file: {file_path}")
-                except Exception as e:
-                    safe_print(f"[FILE] Error deleting physical file: {e}")
-            else:
-                safe_print(f"[FILE] File not found: {file_path}")
+            if row and row[0]:
+                filename, filepath = row
+                # Tạo đường dẫn file đầy đủ
+                file_path = filepath or os.path.join(DOWNLOAD_DIR, filename)
+                
+                # File dùng chung với bản ghi khác (tải trùng được dùng lại) thì giữ lại
+                shared = conn.execute('''SELECT 1 FROM downloads
+                                         WHERE id != ? AND (filename = ? OR filepath = ?) LIMIT 1''',
+                                      (id, filename, file_path)).fetchone()
+                
+                # Xóa file nếu tồn tại
+                if not os.path.exists(file_path):
+                    safe_print(f"[FILE] File not found: {file_path}")
+                elif shared:
+                    safe_print(f"[FILE] Kept file still used by another record: {file_path}")
+                else:
+                    try:
+                        os.remove(file_path)
+                        safe_print(f"[FILE] Deleted physical file: {file_path}")
+                    except Exception as e:
+                        safe_print(f"[FILE] Error deleting physical file: {e}")
 
-        # 2. Xóa record trong DB
-        c.execute("DELETE FROM downloads WHERE id=?", (id,))
-        conn.commit()
-        conn.close()
+            # 2. Xóa record trong DB
+            conn.execute("DELETE FROM downloads WHERE id=?", (id,))
         return jsonify({'success': True})
     except Exception as e:
         safe_print(f"[DB] Error deleting record: {e}")
@@ -363,70 +1280,76 @@ def delete_record(id):
 def clear_history():
     """Clear all download history"""
     try:
-        conn = sqlite3.connect(DB_PATH)
-        c = conn.cursor()
-        c.execute("DELETE FROM downloads")
-        conn.commit()
-        conn.close()
+        with get_db() as conn:
+            conn.execute("DELETE FROM downloads")
         return jsonify({'success': True})
     except Exception as e:
         return jsonify({'success': False, 'error': str(e)})
 
+def fts_query(text):
+    """Turn free text into an FTS5 query: every word must match (as a prefix)"""
+    return ' '.join(f'"{word}"*' for word in re.findall(r'\w+', text))
+
 @app.route("/api/search-history", methods=['GET'])
 def search_history():
-    """Search in download history"""
+    """
+    GET /api/search-history - Full-text search in download history, best matches first.
+    Query: q, limit, offset (from next_offset), plus the /api/history filters
+    """
     try:
-        query = request.args.get('q', '').strip()
-        
-        conn = sqlite3.connect(DB_PATH)
-        c = conn.cursor()
-        c.execute('''SELECT id, title, url, platform, format, file_size, duration, 
-                     filename, status, download_date, error_msg 
-                     FROM downloads 
-                     WHERE title LIKE ? OR platform LIKE ? OR url LIKE ?
-                     ORDER BY download_date DESC LIMIT 50''',
-                  (f'%{query}%', f'%{query}%', f'%{query}%'))
-        
-        rows = c.fetchall()
-        conn.close()
-        
-        results = []
-        for row in rows:
-            results.append({
-                'id': row[0],
-                'title': row[1],
-                'url': row[2],
-                'platform': row[3],
-                'platform_icon': get_platform_icon(row[3]),
-                'format': row[4],
-                'file_size': format_file_size(row[5]) if row[5] else 'N/A',
-                'duration': row[6],
-                'filename': row[7],
-                'status': row[8],
-                'download_date': row[9],
-                'error_msg': row[10]
-            })
+        match = fts_query(request.args.get('q', ''))
+        limit = min(max(int(request.args.get('limit', HISTORY_PAGE_SIZE)), 1), HISTORY_MAX_PAGE_SIZE)
+        offset = max(int(request.args.get('offset', 0)), 0)
+        conditions, params = history_filters(request.args)
+    except (ValueError, TypeError) as e:
+        return jsonify({'success': False, 'error': f"Invalid parameter: {e}"}), 400
+    
+    if not match:
+        return jsonify({'success': True, 'history': [], 'next_offset': None})
+    
+    try:
+        where = ''.join(f" AND {condition}" for condition in conditions)
+        with get_db() as conn:
+            # Title matches weigh more than platform, platform more than URL
+            rows = conn.execute(f'''SELECT {HISTORY_COLUMNS}
+                                    FROM downloads_fts JOIN downloads ON downloads.id = downloads_fts.rowid
+                                    WHERE downloads_fts MATCH ?{where}
+                                    ORDER BY bm25(downloads_fts, 10.0, 1.0, 3.0), downloads.download_date DESC
+                                    LIMIT ? OFFSET ?''',
+                                [match] + params + [limit + 1, offset]).fetchall()
         
-        return jsonify(results)
+        has_more = len(rows) > limit
+        return jsonify({
+            'success': True,
+            'history': [history_row_to_dict(row) for row in rows[:limit]],
+            'next_offset': offset + limit if has_more else None
+        })
     except Exception as e:
-        return jsonify([])
+        safe_print(f"[DB] Search error: {e}")
+        return jsonify({'success': False, 'history': [], 'next_offset': None})
 
-@app.route("/api/export-history", methods=['GET'])
-def export_history():
-    """Export history as JSON"""
+EXPORT_FIELDS = ['title', 'url', 'platform', 'format', 'file_size', 'duration', 'filename', 'status', 'download_date',
+                 'attempts', 'filepath', 'throughput']
+EXPORT_MIMETYPES = {
+    'json': 'application/json',
+    'ndjson': 'application/x-ndjson',
+    'csv': 'text/csv'
+}
+
+def iter_export_chunks(conditions, params):
+    """Yield lists of export records, reading the cursor EXPORT_CHUNK_SIZE rows at a time"""
+    where = f"WHERE {' AND '.join(conditions)}" if conditions else ""
+    # Dedicated connection: a slow client must not hold on to a pooled one
+    conn = connect_db()
     try:
-        conn = sqlite3.connect(DB_PATH)
-        c = conn.cursor()
-        c.execute('''SELECT title, url, platform, format, file_size, duration, 
-                     filename, status, download_date 
-                     FROM downloads ORDER BY download_date DESC''')
-        
-        rows = c.fetchall()
-        conn.close()
-        
-        export_data = []
-        for row in rows:
-            export_data.append({
+        cursor = conn.execute(f'''SELECT title, url, platform, format, file_size, duration, 
+                                  filename, status, download_date, attempts, filepath, throughput 
+                                  FROM downloads {where} ORDER BY download_date DESC, id DESC''', params)
+        while True:
+            rows = cursor.fetchmany(EXPORT_CHUNK_SIZE)
+            if not rows:
+                break
+            yield [{
                 'title': row[0],
                 'url': row[1],
                 'platform': row[2],
@@ -435,12 +1358,75 @@ def export_history():
                 'duration': row[5],
                 'filename': row[6],
                 'status': row[7],
-                'download_date': row[8]
-            })
-        
-        return jsonify(export_data)
-    except Exception as e:
-        return jsonify([])
+                'download_date': row[8],
+                'attempts': row[9] or 1,
+                'filepath': row[10],
+                'throughput': row[11]
+            } for row in rows]
+    finally:
+        conn.close()
+
+def serialize_export(chunks, export_format):
+    """Serialize record chunks as one text piece per chunk"""
+    if export_format == 'json':
+        yield '['
+        separator = ''
+        for records in chunks:
+            yield separator + ','.join(json.dumps(record, ensure_ascii=False) for record in records)
+            separator = ','
+        yield ']'
+    elif export_format == 'ndjson':
+        for records in chunks:
+            yield ''.join(json.dumps(record, ensure_ascii=False) + '\n' for record in records)
+    else:  # csv
+        buffer = io.StringIO()
+        writer = csv.DictWriter(buffer, fieldnames=EXPORT_FIELDS)
+        writer.writeheader()
+        for records in chunks:
+            writer.writerows(records)
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+        if buffer.getvalue():
+            yield buffer.getvalue()
+
+def gzip_stream(pieces):
+    """Compress a stream of text pieces on the fly (gzip container)"""
+    compressor = zlib.compressobj(wbits=31)
+    for piece in pieces:
+        data = compressor.compress(piece.encode('utf-8'))
+        if data:
+            yield data
+    yield compressor.flush()
+
+@app.route("/api/export-history", methods=['GET'])
+def export_history():
+    """
+    GET /api/export-history - Stream history as a file download.
+    Query: format=json|ndjson|csv, gzip=1, media_format=mp4|mp3, plus the other /api/history filters
+    """
+    export_format = request.args.get('format', 'json')
+    if export_format not in EXPORT_MIMETYPES:
+        return jsonify({'success': False, 'error': f"Unsupported format: {export_format}"}), 400
+    try:
+        # `format` selects the file type here, the media format filter of /api/history is `media_format`
+        filters = {key: value for key, value in request.args.items() if key != 'format'}
+        filters['format'] = request.args.get('media_format')
+        conditions, params = history_filters(filters)
+    except (ValueError, TypeError) as e:
+        return jsonify({'success': False, 'error': f"Invalid parameter: {e}"}), 400
+    
+    filename = f"download-history-{datetime.now().strftime('%Y-%m-%d')}.{export_format}"
+    body = serialize_export(iter_export_chunks(conditions, params), export_format)
+    mimetype = EXPORT_MIMETYPES[export_format]
+    
+    if request.args.get('gzip') in ('1', 'true'):
+        body = gzip_stream(body)
+        filename += '.gz'
+        mimetype = 'application/gzip'
+    
+    return Response(body, mimetype=mimetype,
+                    headers={'Content-Disposition': f'attachment; filename="{filename}"'})
 
 # ================== SOCKET ==================
 @socketio.on("connect")
@@ -448,273 +1434,1194 @@ def handle_connect():
     print("Client connected")
     emit("connected", {"status": "ready"})
     # Send current queue state
-    emit("queue_updated", {"queue": download_queue})
+    emit("queue_snapshot", download_queue.state())
 
 @socketio.on("disconnect")
 def handle_disconnect():
     print("Client disconnected")
+    with preview_lock:
+        preview_batches.pop(request.sid, None)
 
-@socketio.on("get_video_info")
-def get_video_info(data):
-    """Get video information without downloading"""
-    url = data.get("url", "").strip()
-    
-    if not url:
-        socketio.emit("error", {"msg": "Vui lòng nhập URL!"})
-        return
-    
-    def fetch_info():
-        try:
-            ydl_opts = {
-                'quiet': True,
-                'no_warnings': True,
-                'extract_flat': False,
-                'skip_download': True,
-            }
-            
-            with yt_dlp.YoutubeDL(ydl_opts) as ydl:
-                info = ydl.extract_info(url, download=False)
-                
-                # Get available formats
-                formats = []
-                if 'formats' in info:
-                    seen = set()
-                    for f in info['formats']:
-                        height = f.get('height')
-                        if height and height not in seen and height <= 2160:
-                            formats.append({
-                                'quality': f"{height}p",
-                                'ext': f.get('ext', 'mp4'),
-                                'filesize': format_file_size(f.get('filesize', 0)) if f.get('filesize') else 'N/A'
-                            })
-                            seen.add(height)
-                
-                formats = sorted(formats, key=lambda x: int(x['quality'].replace('p', '')), reverse=True)
-                
-                duration = info.get('duration', 0)
-                if duration:
-                    duration_int = int(duration)
-                    duration_str = f"{duration_int // 60}:{duration_int % 60:02d}"
-                else:
-                    duration_str = "N/A"
-                
-                # Get thumbnail with fallback
-                thumbnail = info.get('thumbnail', '')
-                if thumbnail:
-                    try:
-                        response = requests.head(thumbnail, timeout=2)
-                        if response.status_code != 200:
-                            thumbnail = ''
-                    except:
-                        thumbnail = ''
-                
-                video_info = {
-                    'title': info.get('title', 'Unknown'),
-                    'thumbnail': thumbnail,
-                    'duration': duration_str,
-                    'uploader': info.get('uploader', 'Unknown'),
-                    'view_count': f"{info.get('view_count', 0):,}" if info.get('view_count') else 'N/A',
-                    'platform': info.get('extractor', 'Unknown'),
-                    'formats': formats[:6]
-                }
-                
-                socketio.emit("video_info", video_info)
-                
-        except Exception as e:
-            safe_print(f"Preview error: {str(e)}")
-            socketio.emit("error", {"msg": f"Không thể lấy thông tin: {str(e)}"})
-    
-    threading.Thread(target=fetch_info, daemon=True).start()
+# ================== VIDEO PREVIEW ==================
+preview_executor = ThreadPoolExecutor(max_workers=PREVIEW_WORKERS, thread_name_prefix="preview")
+preview_lock = threading.Lock()
+preview_jobs = {}     # url_key -> subscribers [(sid, batch, index)] waiting for the same extraction
+preview_batches = {}  # sid -> latest preview batch of that client (older batches are stale)
 
-# ================== QUEUE MANAGEMENT ==================
-@socketio.on("add_to_queue")
-def add_to_queue(data):
-    global download_queue
+def build_video_info(info):
+    """Preview payload (title, duration, available qualities...) from a yt-dlp info dict"""
+    # Get available formats
+    formats = []
+    if 'formats' in info:
+        seen = set()
+        for f in info['formats']:
+            height = f.get('height')
+            if height and height not in seen and height <= 2160:
+                formats.append({
+                    'quality': f"{height}p",
+                    'ext': f.get('ext', 'mp4'),
+                    'filesize': format_file_size(f.get('filesize', 0)) if f.get('filesize') else 'N/A'
+                })
+                seen.add(height)
     
-    urls = data.get("urls", [])
-    fmt = data.get("format", "auto")
-    quality = data.get("quality", "best")
+    formats = sorted(formats, key=lambda x: int(x['quality'].replace('p', '')), reverse=True)
     
-    safe_print(f"\n[QUEUE] Adding {len(urls)} URLs to queue (Format: {fmt}, Quality: {quality})")
+    duration = info.get('duration', 0)
+    if duration:
+        duration_int = int(duration)
+        duration_str = f"{duration_int // 60}:{duration_int % 60:02d}"
+    else:
+        duration_str = "N/A"
     
-    with queue_lock:
-        for url in urls:
-            url = url.strip()
-            if not url:
-                continue
-                
-            # Check if URL already in queue
-            if any(item["url"] == url for item in download_queue):
-                safe_print(f"[QUEUE] Skipping duplicate: {url}")
-                continue
-            
-            # Resolve DNS for network info
-            dns_info = resolve_dns(url)
-            safe_print(f"[DNS] {dns_info.get('domain')} -> {dns_info.get('ip')}")
-            
-            item = {
-                "id": str(uuid.uuid4()),
-                "url": url,
-                "format": fmt,
-                "quality": quality,
-                "status": "pending",  # pending, downloading, completed, error
-                "title": None,
-                "progress": "",
-                "ip": dns_info.get("ip", "Unknown"),
-                "domain": dns_info.get("domain", "Unknown"),
-                "protocol": dns_info.get("protocol", "HTTP")
-            }
-            download_queue.append(item)
-            safe_print(f"[QUEUE] Added: {url}")
+    # Only thumbnails already known to be broken are dropped; new ones are checked after the preview is sent
+    thumbnail = info.get('thumbnail', '')
+    if thumbnail and thumbnail_status(thumbnail) is False:
+        thumbnail = ''
     
-    # Broadcast updated queue to all clients
-    socketio.emit("queue_updated", {"queue": download_queue})
+    return {
+        'title': info.get('title', 'Unknown'),
+        'thumbnail': thumbnail_proxy_url(thumbnail),
+        'thumbnail_url': thumbnail,
+        'duration': duration_str,
+        'uploader': info.get('uploader', 'Unknown'),
+        'view_count': f"{info.get('view_count', 0):,}" if info.get('view_count') else 'N/A',
+        'platform': info.get('extractor', 'Unknown'),
+        'formats': formats[:6]
+    }
+
+thumbnail_checks = OrderedDict()  # thumbnail URL -> (expires_at, reachable)
+thumbnail_lock = threading.Lock()
+
+def thumbnail_status(url):
+    """Cached reachability of a thumbnail: True, False or None if it was not checked recently"""
+    with thumbnail_lock:
+        entry = thumbnail_checks.get(url)
+    if entry and entry[0] > time.monotonic():
+        return entry[1]
+    return None
+
+def remember_thumbnail(url, reachable):
+    with thumbnail_lock:
+        thumbnail_checks[url] = (time.monotonic() + METADATA_CACHE_TTL, reachable)
+        thumbnail_checks.move_to_end(url)
+        while len(thumbnail_checks) > METADATA_CACHE_SIZE:
+            thumbnail_checks.popitem(last=False)
+
+def verify_preview_thumbnail(url, thumbnail, subscribers):
+    """Executor task: warm the thumbnail cache and tell the clients to drop the thumbnail if it is broken"""
+    if cached_thumbnail(thumbnail):
+        return
+    for sid, batch, index in subscribers:
+        socketio.emit("thumbnail_invalid", {"url": url, "batch": batch, "index": index}, to=sid)
+
+def fetch_video_info(url):
+    """Preview payload for url, extracting only on a metadata cache miss"""
+    info = metadata_cache.get(url)
+    if info is None:
+        ydl_opts = {
+            'quiet': True,
+            'no_warnings': True,
+            'extract_flat': False,
+            'skip_download': True,
+        }
+        rate_limiter.acquire_request(parse_url_host(url)[0])
+        with yt_dlp.YoutubeDL(ydl_opts) as ydl:
+            info = metadata_cache.put(url, run_blocking(ydl.extract_info, url, download=False))
+    return build_video_info(info)
+
+def stream_info_batch(urls):
+    """
+    NDJSON lines for /api/info/batch. Extractions run on the bounded preview executor;
+    a URL repeated in the batch is extracted once.
+    """
+    jobs = {}  # url_key -> Future
+    positions = {}  # Future -> [(index, url)]
+    for index, url in enumerate(urls):
+        if not url:
+            continue
+        key = normalize_url(url)
+        if key not in jobs:
+            jobs[key] = preview_executor.submit(fetch_video_info, url)
+        positions.setdefault(jobs[key], []).append((index, url))
+    
+    try:
+        for index, url in enumerate(urls):
+            if not url:
+                yield json.dumps({"index": index, "url": url, "success": False, "error": "Empty URL"}) + "\n"
+        
+        for future in as_completed(positions):
+            try:
+                result = {"success": True, "info": future.result()}
+            except Exception as e:
+                safe_print(f"Preview error: {str(e)}")
+                result = {"success": False, "error": str(e)}
+            for index, url in positions[future]:
+                yield json.dumps(dict(result, index=index, url=url), ensure_ascii=False) + "\n"
+    finally:
+        # Client went away: drop the extractions that have not started yet
+        for future in positions:
+            future.cancel()
+
+def is_stale_preview(sid, batch):
+    """A request is stale once its client disconnected or started a newer preview batch"""
+    return sid not in preview_batches or (batch is not None and preview_batches[sid] != batch)
+
+def run_preview_job(url, key):
+    """Executor task: one extraction per URL, result sent to every client still waiting for it"""
+    with preview_lock:
+        if all(is_stale_preview(sid, batch) for sid, batch, _ in preview_jobs[key]):
+            # Nobody needs this anymore - skip the extraction
+            del preview_jobs[key]
+            return
+    
+    try:
+        video_info, error = fetch_video_info(url), None
+    except Exception as e:
+        safe_print(f"Preview error: {str(e)}")
+        video_info, error = None, str(e)
+    
+    with preview_lock:
+        subscribers = preview_jobs.pop(key)
+        subscribers = [(sid, batch, index) for sid, batch, index in subscribers if not is_stale_preview(sid, batch)]
+    
+    for sid, batch, index in subscribers:
+        if error:
+            socketio.emit("error", {"msg": f"Không thể lấy thông tin: {error}", "batch": batch, "index": index}, to=sid)
+        else:
+            socketio.emit("video_info", dict(video_info, url=url, batch=batch, index=index), to=sid)
+    
+    thumbnail = video_info and video_info.get("thumbnail_url")
+    if thumbnail and subscribers and thumbnail_status(thumbnail) is None:
+        http_executor.submit(verify_preview_thumbnail, url, thumbnail, subscribers)
+
+def subscribe_preview(sid, url, batch, index):
+    """Queue a preview extraction for url, or join the one already queued for the same URL"""
+    key = normalize_url(url)
+    
+    with preview_lock:
+        if batch is not None:
+            preview_batches[sid] = batch
+        else:
+            preview_batches.setdefault(sid, None)
+        
+        subscribers = preview_jobs.get(key)
+        if subscribers is not None:
+            # Same URL already queued or extracting - share its result
+            subscribers.append((sid, batch, index))
+            return
+        preview_jobs[key] = [(sid, batch, index)]
+    
+    preview_executor.submit(run_preview_job, url, key)
+
+@socketio.on("get_video_info")
+def get_video_info(data):
+    """Get video information without downloading (result goes to the requesting client only)"""
+    url = data.get("url", "").strip()
+    
+    if not url:
+        emit("error", {"msg": "Vui lòng nhập URL!"})
+        return
+    
+    subscribe_preview(request.sid, url, data.get("batch"), data.get("index"))
+
+@socketio.on("get_video_info_batch")
+def get_video_info_batch(data):
+    """Preview many URLs in one event; each result arrives as a video_info/error event with its index"""
+    urls = data.get("urls")
+    batch = data.get("batch")
+    
+    if not isinstance(urls, list) or not urls:
+        emit("error", {"msg": "Vui lòng nhập URL!", "batch": batch})
+        return
+    if len(urls) > INFO_BATCH_MAX_URLS:
+        emit("error", {"msg": f"Tối đa {INFO_BATCH_MAX_URLS} link mỗi lần xem trước!", "batch": batch})
+        return
+    
+    for index, url in enumerate(urls):
+        url = str(url).strip()
+        if url:
+            subscribe_preview(request.sid, url, batch, index)
+        else:
+            emit("error", {"msg": "Vui lòng nhập URL!", "batch": batch, "index": index})
+
+# ================== THUMBNAIL CACHE ==================
+thumbnail_cache_lock = threading.Lock()
+thumbnail_fetch_locks = {}  # cache path -> lock held while that thumbnail is fetched
+thumbnail_cache_bytes = 0
+thumbnail_signing_key = os.urandom(32)  # Per process: SECRET_KEY is public, keys signed with it could be forged
+
+def thumbnail_key(url):
+    """Signed key for /api/thumbnail, so the proxy only fetches URLs this server handed out"""
+    encoded = base64.urlsafe_b64encode(url.encode()).decode().rstrip("=")
+    signature = hmac.new(thumbnail_signing_key, url.encode(), hashlib.sha256).hexdigest()[:16]
+    return f"{encoded}.{signature}"
+
+def thumbnail_proxy_url(url):
+    return f"/api/thumbnail/{thumbnail_key(url)}" if url else ''
+
+def thumbnail_url_from_key(key):
+    """Remote URL of a thumbnail key, None if the key is malformed or not signed by us"""
+    encoded = key.rpartition(".")[0]
+    try:
+        url = base64.urlsafe_b64decode(encoded + "=" * (-len(encoded) % 4)).decode()
+    except (ValueError, UnicodeDecodeError):
+        return None
+    return url if hmac.compare_digest(thumbnail_key(url), key) else None
+
+def image_mimetype(data):
+    """Content type from the image signature, None for anything that is not an image"""
+    if data.startswith(b"\xff\xd8\xff"):
+        return "image/jpeg"
+    if data.startswith(b"\x89PNG\r\n\x1a\n"):
+        return "image/png"
+    if data[:4] == b"RIFF" and data[8:12] == b"WEBP":
+        return "image/webp"
+    if data[:6] in (b"GIF87a", b"GIF89a"):
+        return "image/gif"
+    return None
+
+def thumbnail_cache_path(url):
+    return os.path.join(THUMBNAIL_CACHE_DIR, hashlib.sha256(url.encode()).hexdigest())
+
+def scan_thumbnail_cache():
+    """Measure the cache left by the previous run and drop unfinished writes"""
+    global thumbnail_cache_bytes
+    total = 0
+    for entry in os.scandir(THUMBNAIL_CACHE_DIR):
+        if entry.name.endswith(".tmp"):
+            os.remove(entry.path)
+        elif entry.is_file():
+            total += entry.stat().st_size
+    thumbnail_cache_bytes = total
+
+def evict_thumbnails():
+    """Delete the least recently served thumbnails once the cache is over THUMBNAIL_CACHE_SIZE"""
+    global thumbnail_cache_bytes
+    with thumbnail_cache_lock:
+        if thumbnail_cache_bytes <= THUMBNAIL_CACHE_SIZE:
+            return
+        entries = [entry for entry in os.scandir(THUMBNAIL_CACHE_DIR)
+                   if entry.is_file() and not entry.name.endswith(".tmp")]
+        entries.sort(key=lambda entry: entry.stat().st_mtime)
+        # Shrink to 90% so the directory is not rescanned on every new thumbnail
+        for entry in entries:
+            if thumbnail_cache_bytes <= THUMBNAIL_CACHE_SIZE * 0.9:
+                break
+            try:
+                size = entry.stat().st_size
+                os.remove(entry.path)
+                thumbnail_cache_bytes -= size
+            except OSError:
+                pass
+
+def resize_thumbnail(data):
+    """Downscale an image to THUMBNAIL_WIDTH as JPEG; None if FFmpeg is missing or cannot decode it"""
+    ffmpeg = shutil.which("ffmpeg")
+    if not ffmpeg:
+        return None
+    command = [ffmpeg, "-loglevel", "error", "-i", "pipe:0",
+               "-vf", f"scale='min({THUMBNAIL_WIDTH},iw)':-2", "-frames:v", "1",
+               "-c:v", "mjpeg", "-pix_fmt", "yuvj420p", "-q:v", "4", "-f", "image2pipe", "pipe:1"]
+    try:
+        result = subprocess.run(command, input=data, capture_output=True, timeout=15)
+    except (OSError, subprocess.TimeoutExpired):
+        return None
+    return result.stdout if result.returncode == 0 and result.stdout else None
+
+def fetch_thumbnail(url):
+    """Download a remote image (bounded by THUMBNAIL_MAX_SOURCE); None if it is not a usable image"""
+    try:
+        with http_session.get(url, timeout=5, stream=True) as response:
+            response.raise_for_status()
+            data = b""
+            for chunk in response.iter_content(64 * 1024):
+                data += chunk
+                if len(data) > THUMBNAIL_MAX_SOURCE:
+                    return None
+    except requests.RequestException as e:
+        safe_print(f"[THUMB] Could not fetch {url}: {e}")
+        return None
+    return data if image_mimetype(data) else None
+
+def cached_thumbnail(url):
+    """Path of the resized thumbnail of url, fetched on first use; None if the image is unavailable"""
+    global thumbnail_cache_bytes
+    path = thumbnail_cache_path(url)
+    try:
+        os.utime(path)  # Recently served, evicted last
+        return path
+    except FileNotFoundError:
+        pass
+    
+    with thumbnail_cache_lock:
+        fetch_lock = thumbnail_fetch_locks.setdefault(path, threading.Lock())
+    
+    # Concurrent requests for the same thumbnail share a single fetch
+    with fetch_lock:
+        if os.path.exists(path):
+            # Fetched by the request we waited for
+            with thumbnail_cache_lock:
+                if thumbnail_fetch_locks.get(path) is fetch_lock:
+                    del thumbnail_fetch_locks[path]
+            return path
+        
+        data = fetch_thumbnail(url) if thumbnail_status(url) is not False else None
+        remember_thumbnail(url, data is not None)
+        if data is None:
+            with thumbnail_cache_lock:
+                thumbnail_fetch_locks.pop(path, None)
+            return None
+        
+        # Keep the original if it is already smaller (or FFmpeg is not available)
+        resized = run_blocking(resize_thumbnail, data)
+        if resized and len(resized) < len(data):
+            data = resized
+        
+        with open(path + ".tmp", "wb") as f:
+            f.write(data)
+        os.replace(path + ".tmp", path)
+        with thumbnail_cache_lock:
+            thumbnail_cache_bytes += len(data)
+            thumbnail_fetch_locks.pop(path, None)
+    
+    evict_thumbnails()
+    return path
+
+scan_thumbnail_cache()
+
+# ================== QUEUE MANAGEMENT ==================
+def estimate_size(url):
+    """Expected download size in bytes if the video info is already cached, else None"""
+    info = metadata_cache.get(url)
+    if not info:
+        return None
+    return info.get("filesize") or info.get("filesize_approx")
+
+def enqueue_urls(urls, fmt, quality, ratelimit=None, priority=0, client=None, tuning=None, fields=None):
+    """
+    Create queue items for new URLs, skipping duplicates. Returns (added_items, skipped_count).
+    `fields` optionally maps a URL to extra item fields (e.g. a title already known from a playlist).
+    """
+    added = []
+    skipped = 0
+    
+    for url in urls:
+        url = url.strip()
+        if not url:
+            continue
+        
+        # Check if URL already in queue
+        if download_queue.has_url(url):
+            safe_print(f"[QUEUE] Skipping duplicate: {url}")
+            skipped += 1
+            continue
+        
+        # Domain is known right away, the IP is filled in once DNS resolves in the background
+        domain, protocol = parse_url_host(url)
+        
+        item = {
+            "id": str(uuid.uuid4()),
+            "url": url,
+            "format": fmt,
+            "quality": quality,
+            "status": "pending",  # pending, downloading, completed, error
+            "title": None,
+            "progress": "",
+            "ip": None,
+            "domain": domain or "Unknown",
+            "protocol": protocol,
+            "ratelimit": ratelimit,  # Bytes/s for this download, None = server default
+            "priority": priority,
+            "order": time.time(),  # FIFO position; pinned items use it for their manual order
+            "pinned": False,
+            "client": client,
+            "est_size": estimate_size(url),  # Known sizes are scheduled shortest first
+            "tuning": tuning or {}  # Explicit yt-dlp transfer options, the rest is chosen by tune_download
+        }
+        if fields and url in fields:
+            item.update(fields[url])
+        
+        with queue_cond:
+            if not download_queue.add(item):
+                skipped += 1
+                continue
+        added.append(item)
+        safe_print(f"[QUEUE] Added: {url}")
+        
+        resolve_domain(domain).add_done_callback(
+            lambda future, item_id=item["id"], domain=domain: on_item_resolved(item_id, domain, future))
+    
+    if added:
+        # Running workers pick up new items without a restart (one wake-up for the whole batch)
+        with queue_cond:
+            queue_cond.notify_all()
+    return added, skipped
+
+def on_item_resolved(item_id, domain, future):
+    """Fill in the IP of a queued item once its DNS lookup finishes (pushed to clients as item_changed)"""
+    try:
+        ip = future.result()
+    except Exception:
+        ip = "Unknown"
+    safe_print(f"[DNS] {domain} -> {ip}")
+    download_queue.update(item_id, ip=ip)
+
+@socketio.on("queue_resync")
+def queue_resync():
+    """Client detected a sequence gap - send it a fresh snapshot"""
+    emit("queue_snapshot", download_queue.state())
+
+@socketio.on("add_to_queue")
+def add_to_queue(data):
+    urls = data.get("urls", [])
+    fmt = data.get("format", "auto")
+    quality = data.get("quality", "best")
+    
+    safe_print(f"\n[QUEUE] Adding {len(urls)} URLs to queue (Format: {fmt}, Quality: {quality})")
+    
+    if data.get("playlist"):
+        submit_playlist_intake(urls, fmt, quality, client=request.sid)
+    else:
+        enqueue_urls(urls, fmt, quality, client=request.sid)
 
 @socketio.on("remove_from_queue")
 def remove_from_queue(data):
-    global download_queue
-    
     item_id = data.get("id")
     
-    with queue_lock:
-        download_queue = [item for item in download_queue if item["id"] != item_id or item["status"] == "downloading"]
-    
-    socketio.emit("queue_updated", {"queue": download_queue})
+    download_queue.remove(item_id, statuses=("pending", "completed", "error"))
+
+@socketio.on("move_to_front")
+def move_to_front(data):
+    reorder_queue([data.get("id")])
+
+def reorder_queue(ids):
+    """Pin pending items ahead of everything else at their priority, in the given order. Returns how many moved."""
+    with queue_cond:
+        pending = [download_queue.get(item_id) for item_id in ids]
+        pending = [item for item in pending if item and item["status"] == "pending"]
+        if not pending:
+            return 0
+        
+        front = min((item["order"] for item in download_queue.with_status("pending") if item.get("pinned")),
+                    default=0)
+        for position, item in enumerate(pending):
+            download_queue.update(item["id"], pinned=True, order=front - len(pending) + position)
+        queue_cond.notify_all()
+    return len(pending)
+
+def set_item_priority(item_id, priority):
+    with queue_cond:
+        item = download_queue.get(item_id)
+        if not item or item["status"] != "pending":
+            return False
+        download_queue.update(item_id, priority=priority)
+        queue_cond.notify_all()
+    return True
 
 @socketio.on("clear_queue")
 def clear_queue():
-    global download_queue
-    
-    with queue_lock:
-        # Keep only downloading items
-        download_queue = [item for item in download_queue if item["status"] == "downloading"]
-    
-    socketio.emit("queue_updated", {"queue": download_queue})
+    # Keep only items that are being worked on
+    download_queue.clear(keep_statuses=("downloading", "processing"))
 
 @socketio.on("start_queue_download")
 def start_queue_download():
-    global is_downloading
+    global is_downloading, active_workers
     
-    if is_downloading:
-        safe_print("[QUEUE] Already downloading")
+    with queue_cond:
+        pending_count = download_queue.count("pending")
+        was_downloading = is_downloading
+        
+        if pending_count or active_intakes:
+            # Top up the worker pool; running workers also pick up the new items.
+            # While a playlist is being enumerated more items are on the way.
+            spawn_count = min(MAX_CONCURRENT_DOWNLOADS - active_workers,
+                              MAX_CONCURRENT_DOWNLOADS if active_intakes else pending_count)
+            active_workers += spawn_count
+            is_downloading = True
+            queue_cond.notify_all()
+    
+    if not (pending_count or active_intakes):
+        if was_downloading:
+            safe_print("[QUEUE] Already downloading")
+        else:
+            socketio.emit("error", {"msg": "Không có video nào trong hàng đợi!"})
         return
     
-    # Find first pending item
-    pending_items = [item for item in download_queue if item["status"] == "pending"]
-    if not pending_items:
-        socketio.emit("error", {"msg": "Không có video nào trong hàng đợi!"})
+    if not was_downloading:
+        socketio.emit("download_started", {})
+    
+    # Start download workers in background tasks (green threads in eventlet mode)
+    for _ in range(spawn_count):
+        socketio.start_background_task(process_queue)
+
+# ================== PLAYLIST INTAKE ==================
+intake_executor = ThreadPoolExecutor(max_workers=PLAYLIST_INTAKE_WORKERS, thread_name_prefix="playlist")
+
+def submit_playlist_intake(urls, fmt, quality, **options):
+    """Expand playlist/channel URLs in the background. Returns [{id, url}] of the started intakes."""
+    global active_intakes
+    intakes = []
+    for url in urls:
+        url = url.strip()
+        if not url:
+            continue
+        intake_id = str(uuid.uuid4())
+        with queue_cond:
+            active_intakes += 1
+        intake_executor.submit(run_playlist_intake, intake_id, url, fmt, quality, options)
+        intakes.append({"id": intake_id, "url": url})
+    return intakes
+
+def resolve_playlist(ydl, url):
+    """Raw (unprocessed) extractor result for url, following redirects to other extractors"""
+    result = run_blocking(ydl.extract_info, url, download=False, process=False)
+    for _ in range(3):
+        if result.get("_type") not in ("url", "url_transparent"):
+            break
+        result = run_blocking(ydl.extract_info, result["url"], ie_key=result.get("ie_key"), download=False, process=False)
+    return result
+
+def iter_playlist_entries(entries):
+    """Iterate entries as the extractor produces them (generators and paged lists fetch pages on demand)"""
+    if isinstance(entries, yt_dlp.utils.PagedList):
+        start = 0
+        while True:
+            page = entries.getslice(start, start + PLAYLIST_INTAKE_BATCH)
+            if not page:
+                return
+            yield from page
+            start += len(page)
+    else:
+        yield from entries or []
+
+def is_single_video_entry(ydl, entry):
+    """Whether a flat url entry is known to be one video, judged by its extractor without extracting it"""
+    if not entry.get("ie_key"):
+        return True
+    try:
+        return ydl.get_info_extractor(entry["ie_key"]).is_single_video(entry["url"]) is True
+    except Exception:
+        return True
+
+def iter_video_entries(ydl, entries, seen, depth=0):
+    """
+    Video entries of a playlist. Nested playlists (a channel returns its Videos/Shorts/Live tabs)
+    are entered instead of being queued, since a queue item must be a single video.
+    """
+    for entry in iter_playlist_entries(entries):
+        if not entry or not (entry.get("webpage_url") or entry.get("url")):
+            continue
+        kind = entry.get("_type")
+        if kind in ("url", "url_transparent"):
+            nested = not is_single_video_entry(ydl, entry)
+        else:
+            nested = kind in ("playlist", "multi_video")
+        if not nested:
+            yield entry
+            continue
+        
+        url = entry.get("webpage_url") or entry["url"]
+        if depth >= PLAYLIST_MAX_DEPTH or url in seen:
+            continue
+        seen.add(url)
+        if "entries" not in entry:
+            rate_limiter.acquire_request(parse_url_host(url)[0])
+            resolved = resolve_playlist(ydl, entry.get("url") or url)
+            if resolved.get("_type") not in ("playlist", "multi_video"):
+                # The extractor could return either, this one is a video
+                yield entry
+                continue
+            entry = resolved
+        yield from iter_video_entries(ydl, entry.get("entries"), seen, depth + 1)
+
+def downloaded_urls(urls):
+    """Subset of urls that already have a successful download in history"""
+    placeholders = ",".join("?" * len(urls))
+    with get_db() as conn:
+        rows = conn.execute(f"SELECT url FROM downloads WHERE status = 'success' AND url IN ({placeholders})",
+                            urls).fetchall()
+    return {row[0] for row in rows}
+
+def enqueue_playlist_batch(entries, fmt, quality, playlist_title, options):
+    """Queue a batch of flat playlist entries. Returns (added_count, skipped_count)."""
+    fields = {}
+    for entry in entries:
+        # Flat entries only have the page URL; fully extracted ones also carry media URLs in "url"
+        fields[entry.get("webpage_url") or entry["url"]] = {"title": entry.get("title"), "playlist": playlist_title}
+    
+    done = downloaded_urls(list(fields))
+    added, skipped = enqueue_urls([url for url in fields if url not in done], fmt, quality, fields=fields, **options)
+    return len(added), skipped + len(done)
+
+def run_playlist_intake(intake_id, url, fmt, quality, options):
+    """Executor task: enumerate one playlist with flat extraction, queueing entries batch by batch"""
+    global active_intakes
+    progress = {"id": intake_id, "url": url, "title": None, "found": 0, "added": 0, "skipped": 0, "done": False}
+    try:
+        ydl_opts = {
+            "quiet": True,
+            "no_warnings": True,
+            "extract_flat": "in_playlist",  # Entry pages are not fetched, downloads extract them later
+            "lazy_playlist": True,
+        }
+        rate_limiter.acquire_request(parse_url_host(url)[0])
+        with yt_dlp.YoutubeDL(ydl_opts) as ydl:
+            result = resolve_playlist(ydl, url)
+            if result.get("_type") in ("playlist", "multi_video"):
+                progress["title"] = result.get("title")
+                entries = iter_video_entries(ydl, result.get("entries"), {url})
+            else:
+                # Not a playlist, queue the video itself
+                entries = [{"url": url, "title": result.get("title")}]
+            
+            def flush(batch):
+                added, skipped = enqueue_playlist_batch(batch, fmt, quality, progress["title"], options)
+                progress["found"] += len(batch)
+                progress["added"] += added
+                progress["skipped"] += skipped
+                socketio.emit("playlist_progress", progress)
+            
+            safe_print(f"[PLAYLIST] Enumerating {progress['title'] or url}")
+            batch = []
+            for entry in itertools.islice(entries, PLAYLIST_MAX_ENTRIES):
+                batch.append(entry)
+                if len(batch) >= PLAYLIST_INTAKE_BATCH:
+                    # Workers can start on these while the next pages are fetched
+                    flush(batch)
+                    batch = []
+            if batch:
+                flush(batch)
+        
+        safe_print(f"[PLAYLIST] {progress['title'] or url}: {progress['found']} entries, "
+                   f"{progress['added']} queued, {progress['skipped']} skipped")
+    except Exception as e:
+        safe_print(f"[PLAYLIST] Error enumerating {url}: {e}")
+        progress["error"] = "Không thể đọc danh sách phát"
+    finally:
+        with queue_cond:
+            active_intakes -= 1
+            # Idle workers re-check whether there is anything left to wait for
+            queue_cond.notify_all()
+        progress["done"] = True
+        socketio.emit("playlist_progress", progress)
+
+# ================== DOWNLOAD TUNING ==================
+# API name -> (yt-dlp option, min, max)
+TUNING_OPTIONS = {
+    "fragments": ("concurrent_fragment_downloads", 1, 16),
+    "http_chunk_size": ("http_chunk_size", 256 * 1024, 100 * 1024 * 1024),
+    "buffersize": ("buffersize", 1024, 16 * 1024 * 1024),
+}
+throughput_lock = threading.Lock()
+domain_throughput = {}  # domain -> EMA of bytes/s measured on finished downloads
+
+def parse_tuning(data):
+    """Per-job transfer options from an API body, keyed by yt-dlp option. Raises ValueError."""
+    tuning = {}
+    for name, (option, low, high) in TUNING_OPTIONS.items():
+        value = data.get(name)
+        if value is None:
+            continue
+        if isinstance(value, bool) or not isinstance(value, int) or not low <= value <= high:
+            raise ValueError(f"{name} must be an integer between {low} and {high}")
+        tuning[option] = value
+    return tuning
+
+def record_throughput(domain, nbytes, seconds):
+    """Feed a finished transfer into the domain's throughput average"""
+    if nbytes <= 0 or seconds <= 0:
         return
+    speed = nbytes / seconds
+    with throughput_lock:
+        previous = domain_throughput.get(domain)
+        domain_throughput[domain] = speed if previous is None else 0.7 * previous + 0.3 * speed
+
+def tune_download(item):
+    """
+    yt-dlp transfer options for item. Explicit per-job values win; the defaults adapt to
+    the throughput measured for the item's domain and to how many downloads are running.
+    """
+    with throughput_lock:
+        speed = domain_throughput.get(item.get("domain"))
+    running = max(1, download_queue.count("downloading"))
+    share = max(1, min(MAX_FRAGMENT_CONCURRENCY, TOTAL_FRAGMENT_CONNECTIONS // running))
+    
+    if speed is None:
+        fragments, chunk_size, buffer_size = min(share, FRAGMENT_CONCURRENCY), HTTP_CHUNK_SIZE, 64 * 1024
+    else:
+        # Slow hosts usually limit each connection, more parallel fragments make up for it
+        fragments = share if speed < SLOW_CONNECTION_SPEED else min(share, FRAGMENT_CONCURRENCY)
+        # About 5 seconds per range request and 50 ms per read
+        chunk_size = int(min(max(speed * 5, 1024 * 1024), 50 * 1024 * 1024))
+        buffer_size = int(min(max(speed * 0.05, 16 * 1024), 1024 * 1024))
     
-    is_downloading = True
-    socketio.emit("download_started", {})
+    tuning = {
+        "concurrent_fragment_downloads": fragments,
+        "http_chunk_size": chunk_size,
+        "buffersize": buffer_size,
+    }
+    tuning.update(item.get("tuning") or {})
+    return tuning
+
+# ================== POST-PROCESSING PLANNER ==================
+# Codecs the mp4 container holds as they are (yt-dlp codec ids, before the first ".")
+MP4_VIDEO_CODECS = {"avc1", "avc3", "h264", "hev1", "hvc1", "h265", "hevc", "av01", "vp09", "vp9", "mp4v", "none"}
+MP4_AUDIO_CODECS = {"mp4a", "aac", "mp3", "opus", "ac-3", "ac3", "ec-3", "eac3", "flac", "alac", "none"}
+
+def codec_family(codec):
+    return (codec or "").split(".")[0].lower()
+
+def plan_postprocess(fmt, info):
+    """
+    Cheapest way from a downloaded file to the requested format. Returns a job with
+    path "none" (already there), "remux" (stream copy) or "transcode", the yt-dlp
+    postprocessors for it and, when the codecs are unknown, a transcode fallback.
+    """
+    vcodec, acodec = codec_family(info.get("vcodec")), codec_family(info.get("acodec"))
+    job = {"info": info, "path": "none", "postprocessors": [], "fallback": []}
     
-    # Start download in background thread
-    threading.Thread(target=process_queue, daemon=True).start()
+    if fmt == "mp3":
+        # FFmpegExtractAudio copies the stream when it already is mp3
+        job["path"] = "remux" if acodec == "mp3" else "transcode"
+        job["postprocessors"] = [{"key": "FFmpegExtractAudio", "preferredcodec": "mp3", "preferredquality": "320"}]
+    elif fmt == "mp4" and info.get("ext") != "mp4":
+        convert = [{"key": "FFmpegVideoConvertor", "preferedformat": "mp4"}]
+        remux = [{"key": "FFmpegVideoRemuxer", "preferedformat": "mp4"}]
+        if (vcodec and vcodec not in MP4_VIDEO_CODECS) or (acodec and acodec not in MP4_AUDIO_CODECS):
+            job["path"], job["postprocessors"] = "transcode", convert
+        else:
+            # Compatible or unknown codecs (e.g. direct file links): try a stream copy first
+            job["path"], job["postprocessors"] = "remux", remux
+            if not (vcodec and acodec):
+                job["fallback"] = convert
+    return job
+
+# ================== DEDUPLICATION ==================
+dedupe_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="dedupe")  # Hashing is disk bound
+
+def in_download_dir(path):
+    return os.path.abspath(path).startswith(os.path.abspath(DOWNLOAD_DIR) + os.sep)
+
+def file_sha256(path):
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1024 * 1024), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+def dedupe_video_id(item):
+    """
+    Video id of the dedupe key. The Generic extractor derives its id from the URL basename only
+    (/a/clip.mp4 and /b/clip.mp4, or /download?id=1 and ?id=2, collide), so its files are keyed by URL.
+    """
+    if item.get("extractor") == "Generic":
+        return normalize_url(item["url"])
+    return item.get("video_id")
+
+def find_downloaded_file(item):
+    """Path of an earlier download of the same video, format and quality that is still intact, else None"""
+    video_id = dedupe_video_id(item)
+    if not video_id:
+        return None
+    with get_db() as conn:
+        row = conn.execute('''SELECT filepath, file_size FROM downloaded_files
+                              WHERE extractor = ? AND video_id = ? AND format = ? AND quality = ?''',
+                           (item.get("extractor"), video_id, item["format"], item.get("quality", "best"))).fetchone()
+    if row and in_download_dir(row[0]) and os.path.isfile(row[0]) and os.path.getsize(row[0]) == row[1]:
+        return row[0]
+    return None
+
+def register_download(item):
+    """
+    Executor task: index a finished file by video and by content hash. A file with the
+    same content already on disk (e.g. the same video from another URL) is hardlinked.
+    """
+    path = item["filepath"]
+    try:
+        if not os.path.isfile(path):
+            return
+        digest = run_blocking(file_sha256, path)
+        with get_db() as conn:
+            rows = conn.execute("SELECT filepath FROM downloaded_files WHERE sha256 = ? AND filepath != ?",
+                                (digest, path)).fetchall()
+        
+        for (existing,) in rows:
+            if not (in_download_dir(existing) and os.path.isfile(existing)):
+                continue
+            if not os.path.samefile(existing, path):
+                link_identical(existing, path)
+            break
+        
+        video_id = dedupe_video_id(item)
+        if video_id:
+            db_write('''INSERT OR REPLACE INTO downloaded_files
+                        (extractor, video_id, format, quality, filepath, file_size, sha256, created_at)
+                        VALUES (?, ?, ?, ?, ?, ?, ?, ?)''',
+                     (item.get("extractor"), video_id, item["format"], item.get("quality", "best"),
+                      path, os.path.getsize(path), digest, time.time()))
+    except OSError as e:
+        safe_print(f"[DEDUPE] Could not index {path}: {e}")
+
+def link_identical(existing, path):
+    """Replace path with a hardlink to existing (same content) in one atomic rename"""
+    temp_path = path + ".dedupe"
+    try:
+        os.link(existing, temp_path)
+        os.replace(temp_path, path)
+        safe_print(f"[DEDUPE] {os.path.basename(path)} is identical to {os.path.basename(existing)}, hardlinked")
+    except OSError as e:
+        # Hardlinks are an optimisation - a filesystem without them keeps both copies
+        safe_print(f"[DEDUPE] Could not hardlink {path}: {e}")
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
 
 # ================== DOWNLOAD PROCESSOR ==================
+# Errors that will fail the same way on every attempt
+# Not a bare "Sign in": YouTube's bot check ("Sign in to confirm you're not a bot") is rate based
+PERMANENT_ERRORS = ("Video unavailable", "Private video", "Sign in to confirm your age", "members-only",
+                    "Join this channel to get access", "HTTP Error 403", "HTTP Error 404",
+                    "HTTP Error 410", "Unsupported URL", "is not a valid URL", "copyright", "removed by",
+                    "ffmpeg not found", "ffprobe and ffmpeg not found", "Postprocessing")
+# The host asks us to slow down - pause the whole domain, not only this item
+THROTTLE_ERRORS = ("HTTP Error 429", "Too Many Requests", "rate-limit", "rate limit", "throttl", "not a bot")
+
+def classify_download_error(message):
+    """Return "permanent", "throttled" or "transient" for a raw yt-dlp error message"""
+    lowered = message.lower()
+    if any(pattern.lower() in lowered for pattern in PERMANENT_ERRORS):
+        return "permanent"
+    if any(pattern.lower() in lowered for pattern in THROTTLE_ERRORS):
+        return "throttled"
+    # Timeouts, 5xx, dropped connections and anything unknown get a bounded number of retries
+    return "transient"
+
+def schedule_retry(item_id):
+    """
+    Put a failed item back as pending with exponential backoff. Returns False if it failed for good
+    (an item removed from the queue meanwhile counts as handled).
+    """
+    progress_aggregator.discard(item_id)
+    with queue_cond:
+        item = download_queue.get(item_id)
+        if item is None:
+            return True
+        attempts = item.get("attempts", 1)
+        kind = item.get("error_kind", "transient")
+        if kind == "permanent" or attempts >= MAX_DOWNLOAD_ATTEMPTS:
+            return False
+        
+        # Exponential backoff with jitter, so a failed batch does not retry in lockstep
+        delay = min(RETRY_MAX_DELAY, RETRY_BASE_DELAY * 2 ** (attempts - 1))
+        delay = random.uniform(delay / 2, delay)
+        if kind == "throttled":
+            domain = item.get("domain")
+            domain_cooldowns[domain] = max(domain_cooldowns.get(domain, 0), time.time() + DOMAIN_COOLDOWN)
+            delay = max(delay, DOMAIN_COOLDOWN)
+        
+        download_queue.update(item_id, status="pending", retry_at=time.time() + delay,
+                              progress=f"🔁 {attempts}/{MAX_DOWNLOAD_ATTEMPTS}")
+        queue_cond.notify_all()
+    
+    safe_print(f"[RETRY] {item['url']} failed ({kind}), attempt {attempts}/{MAX_DOWNLOAD_ATTEMPTS}, retrying in {delay:.0f}s")
+    socketio.emit("status", {"id": item_id, "msg": f"🔁 Thử lại sau {delay:.0f} giây (lần {attempts + 1}/{MAX_DOWNLOAD_ATTEMPTS})"})
+    return True
+
+class PendingIndex:
+    """
+    Pending items grouped by (client, domain), each group a heap ordered by the static part of the
+    schedule: priority, then manually pinned order, then shortest job first for known sizes, then FIFO.
+    Picking compares only the head of each group with a free domain, adding fairness between the
+    groups' clients (fewer running downloads, least recently served) after the pinned order.
+    Items waiting for a retry sit in a separate heap until they are due.
+
+    Kept in sync from queue deltas; heap entries of items that changed or stopped being pending
+    are dropped lazily when they reach the top. Caller holds queue_lock.
+    """
+    SCHEDULE_FIELDS = {"status", "priority", "pinned", "order", "est_size", "retry_at", "client", "domain"}
+
+    def __init__(self):
+        self._groups = {}   # (client, domain) -> heap [(key, token, item_id)]
+        self._delayed = []  # heap [(retry_at, token, item_id)]
+        self._tokens = {}   # item_id -> token of its only valid heap entry
+        self._counter = itertools.count()
+        self._entries = 0
+
+    @staticmethod
+    def item_key(item):
+        pinned = item.get("pinned", False)
+        return (-item.get("priority", 0),
+                not pinned,
+                item.get("order", 0) if pinned else 0,
+                item.get("est_size") or float("inf"),
+                item.get("order", 0))
+
+    def on_change(self, event, payload):
+        if event == "item_removed":
+            self._tokens.pop(payload["id"], None)
+        elif event == "item_added":
+            self.push(download_queue.get(payload["item"]["id"]))
+        elif payload["changes"].keys() & self.SCHEDULE_FIELDS:
+            self.push(download_queue.get(payload["id"]))
+
+    def push(self, item):
+        """(Re)index an item; any older entry of it becomes stale"""
+        if item is None or item["status"] != "pending":
+            if item is not None:
+                self._tokens.pop(item["id"], None)
+            return
+        token = next(self._counter)
+        self._tokens[item["id"]] = token
+        if item.get("retry_at", 0) > time.time():
+            heapq.heappush(self._delayed, (item["retry_at"], token, item["id"]))
+        else:
+            group = self._groups.setdefault((item.get("client"), item.get("domain")), [])
+            heapq.heappush(group, (self.item_key(item), token, item["id"]))
+        self._entries += 1
+        if self._entries > 2 * len(self._tokens) + 1000:
+            self._compact()
+
+    def _compact(self):
+        """Drop stale entries buried in the heaps (many re-prioritisations of the same items)"""
+        for group, heap in list(self._groups.items()):
+            heap[:] = [entry for entry in heap if self._tokens.get(entry[2]) == entry[1]]
+            heapq.heapify(heap)
+            if not heap:
+                del self._groups[group]
+        self._delayed = [entry for entry in self._delayed if self._tokens.get(entry[2]) == entry[1]]
+        heapq.heapify(self._delayed)
+        self._entries = sum(len(heap) for heap in self._groups.values()) + len(self._delayed)
+
+    def pick(self, domain_ready, client_load):
+        """Best due pending item whose domain passes domain_ready(domain), or None"""
+        now = time.time()
+        while self._delayed and self._delayed[0][0] <= now:
+            _, token, item_id = heapq.heappop(self._delayed)
+            self._entries -= 1
+            if self._tokens.get(item_id) == token:
+                self.push(download_queue.get(item_id))
+        
+        best = best_key = None
+        for group, heap in list(self._groups.items()):
+            while heap and self._tokens.get(heap[0][2]) != heap[0][1]:
+                heapq.heappop(heap)
+                self._entries -= 1
+            if not heap:
+                del self._groups[group]
+                continue
+            client, domain = group
+            if not domain_ready(domain):
+                continue
+            key, _, item_id = heap[0]
+            key = key[:3] + (client_load.get(client, 0), client_served.get(client, 0)) + key[3:]
+            if best is None or key < best_key:
+                best, best_key = item_id, key
+        return download_queue.get(best) if best else None
+
+pending_index = PendingIndex()
+
+def next_pending_item():
+    """Return the best pending item that is due and whose domain has a free slot (caller holds queue_lock)"""
+    now = time.time()
+    client_load = {}
+    for item in download_queue.with_status("downloading"):
+        client_load[item.get("client")] = client_load.get(item.get("client"), 0) + 1
+    
+    def domain_ready(domain):
+        return domain_cooldowns.get(domain, 0) <= now and active_domains.get(domain, 0) < MAX_DOWNLOADS_PER_DOMAIN
+    
+    return pending_index.pick(domain_ready, client_load)
+
 def process_queue():
-    global is_downloading, download_queue
+    """Download worker - several run concurrently, each pulling pending items until none are left"""
+    global is_downloading, active_workers
     
     while True:
         # Find next pending item
         current_item = None
-        with queue_lock:
-            for item in download_queue:
-                if item["status"] == "pending":
-                    current_item = item
-                    item["status"] = "downloading"
+        with queue_cond:
+            while True:
+                current_item = next_pending_item()
+                if current_item or not (download_queue.count("pending") or active_intakes):
                     break
+                # Remaining items belong to busy domains, wait for a retry or are still being enumerated
+                queue_cond.wait(timeout=1)
+            
+            if not current_item:
+                # No more items to download
+                active_workers -= 1
+                # With conversions still running, the post-processing pool reports completion instead
+                is_last_worker = active_workers == 0 and not active_postprocess
+                if active_workers == 0:
+                    is_downloading = False
+                break
+            
+            download_queue.update(current_item["id"], status="downloading",
+                                  attempts=current_item.get("attempts", 0) + 1)
+            client_served[current_item.get("client")] = time.monotonic()
+            domain = current_item.get("domain")
+            active_domains[domain] = active_domains.get(domain, 0) + 1
         
-        if not current_item:
-            # No more items to download
-            break
+        # Download this item
+        try:
+            success, title, job = download_single_item(current_item)
+        except Exception as e:
+            safe_print(f"[WORKER] Unexpected error: {e}")
+            success, title, job = False, None, None
         
-        # Broadcast queue update
-        socketio.emit("queue_updated", {"queue": download_queue})
+        # Free the domain slot for the other workers
+        with queue_cond:
+            active_domains[domain] -= 1
+            if not active_domains[domain]:
+                del active_domains[domain]
+            queue_cond.notify_all()
         
-        # Download this item
-        success, title = download_single_item(current_item)
+        if not success and schedule_retry(current_item["id"]):
+            continue
         
-        # Update status and emit success notification
+        if job:
+            submit_postprocess(current_item, title, job)
+            continue
+        
+        finish_item(current_item, success, title)
+    
+    if is_last_worker:
+        socketio.emit("all_downloads_complete", {})
+        safe_print("\n[QUEUE] All downloads complete!")
+
+postprocess_executor = ThreadPoolExecutor(max_workers=POSTPROCESS_WORKERS, thread_name_prefix="postprocess")
+
+def submit_postprocess(item, title, job):
+    """Queue the FFmpeg step of a downloaded item; the item shows as "processing" until it is done"""
+    global active_postprocess
+    progress_aggregator.discard(item["id"])
+    with queue_lock:
+        active_postprocess += 1
+        download_queue.update(item["id"], status="processing", progress=f"⚙️ {job['path']}")
+    postprocess_executor.submit(run_postprocess, item, title, job)
+
+def run_postprocess(item, title, job):
+    """Pool task: run the item's postprocessors (FFmpeg subprocesses) and record the outcome"""
+    global active_postprocess
+    item_id = item["id"]
+    socketio.emit("status", {"id": item_id, "msg": f"Đang xử lý: {title}", "percent": "100%"})
+    
+    def run(postprocessors):
+        ydl_opts = {
+            "postprocessors": postprocessors,
+            "quiet": True,
+            "no_warnings": True,
+        }
+        with yt_dlp.YoutubeDL(ydl_opts) as ydl:
+            info = run_blocking(ydl.post_process, job["info"]["filepath"], dict(job["info"]))
+        # Converted files get a new name
+        download_queue.update(item_id, filepath=info.get("filepath"))
+    
+    path = job["path"]
+    try:
+        try:
+            run(job["postprocessors"])
+        except Exception as e:
+            if not job["fallback"]:
+                raise
+            # The stream copy was rejected, the codecs really need converting
+            safe_print(f"[POSTPROCESS] Remux failed for {title} ({e}), transcoding")
+            path = "transcode"
+            download_queue.update(item_id, pp_path=path)
+            run(job["fallback"])
         with queue_lock:
-            for item in download_queue:
-                if item["id"] == current_item["id"]:
-                    item["status"] = "completed" if success else "error"
-                    item["progress"] = "✅" if success else "❌"
-                    break
+            stats["postprocess_paths"][path] += 1
+        success = True
+    except Exception as e:
+        safe_print(f"[POSTPROCESS] Failed for {title}: {e}")
+        download_queue.update(item_id, last_error="Lỗi khi xử lý video (FFmpeg)")
+        socketio.emit("error", {"id": item_id, "msg": "Lỗi: Lỗi khi xử lý video (FFmpeg)"})
+        success = False
+    
+    try:
+        finish_item(item, success, title)
+    finally:
+        # Always release the slot, or the queue would never report completion
+        with queue_lock:
+            active_postprocess -= 1
+            all_done = active_postprocess == 0 and active_workers == 0
+    if all_done:
+        socketio.emit("all_downloads_complete", {})
+        safe_print("\n[QUEUE] All downloads complete!")
+
+def remove_completed_item(item_id):
+    """Auto-remove a finished item from the queue after a short delay"""
+    socketio.sleep(3)  # Wait 3 seconds before removing
+    download_queue.remove(item_id, statuses=("completed", "error"))
+
+def finish_item(current_item, success, title):
+    """Record the outcome of a downloaded item: queue status, statistics, notifications and history"""
+    # Update status and statistics
+    progress_aggregator.discard(current_item["id"])
+    with queue_lock:
+        # Latest attempt count and error of this item
+        latest = download_queue.get(current_item["id"])
+        if latest is None:
+            # Removed from the queue meanwhile, nothing left to report
+            return
+        current_item = dict(latest)
+        download_queue.update(current_item["id"],
+                              status="completed" if success else "error",
+                              progress="✅" if success else "❌")
         
-        # Update statistics
         stats["total_downloads"] += 1
         if success:
             stats["successful_downloads"] += 1
+            stats["total_bytes"] += current_item.get("transfer_bytes") or 0
+            stats["transfer_seconds"] += current_item.get("transfer_seconds") or 0
         else:
             stats["failed_downloads"] += 1
+    
+    # Emit individual item completion notification
+    socketio.emit("item_completed", {
+        "id": current_item["id"],
+        "title": title or current_item.get("title", "Video"),
+        "success": success
+    })
+    
+    # Auto-remove completed item after delay
+    socketio.start_background_task(remove_completed_item, current_item["id"])
+    
+    if success and DEDUPE_DOWNLOADS and current_item.get("filepath") and not current_item.get("deduplicated"):
+        dedupe_executor.submit(register_download, current_item)
+    
+    # Save to database (History)
+    try:
+        db_record = {
+            'title': title or current_item.get("title", "Video"),
+            'url': current_item["url"],
+            'platform': current_item.get("domain", "Unknown"), # We use domain as platform proxy here, or info['extractor'] if available
+            'format': current_item["format"],
+            'status': 'success' if success else 'failed',
+            'error_msg': None if success else current_item.get("last_error", "Download failed"),
+            'attempts': current_item.get("attempts", 1),
+            'duration': current_item.get("duration", "N/A"),
+            'filename': "unknown_file",
+            'file_size': 0,
+            'throughput': current_item.get("throughput"),
+            'thumbnail': current_item.get("thumbnail")
+        }
         
-        # Broadcast queue update
-        socketio.emit("queue_updated", {"queue": download_queue})
-        
-        # Emit individual item completion notification
-        if success:
-            socketio.emit("item_completed", {
-                "id": current_item["id"],
-                "title": title or current_item.get("title", "Video"),
-                "success": True
-            })
-        else:
-            socketio.emit("item_completed", {
-                "id": current_item["id"],
-                "title": title or current_item.get("title", "Video"),
-                "success": False
-            })
-        
-        # Auto-remove completed item after delay
-        def remove_completed_item(item_id):
-            global download_queue
-            time.sleep(3)  # Wait 3 seconds before removing
-            with queue_lock:
-                download_queue = [i for i in download_queue if i["id"] != item_id or i["status"] not in ["completed", "error"]]
-            socketio.emit("queue_updated", {"queue": download_queue})
-        
-        threading.Thread(target=remove_completed_item, args=(current_item["id"],), daemon=True).start()
+        # Final file as reported by yt-dlp (after merging and post-processing)
+        filepath = current_item.get("filepath")
+        if success and filepath:
+            db_record['filepath'] = os.path.abspath(filepath)
+            db_record['filename'] = os.path.basename(filepath)
+            db_record['file_size'] = get_file_size(filepath)
         
-        # Save to database (History)
-        try:
-            db_record = {
-                'title': title or current_item.get("title", "Video"),
-                'url': current_item["url"],
-                'platform': current_item.get("domain", "Unknown"), # We use domain as platform proxy here, or info['extractor'] if available
-                'format': current_item["format"],
-                'status': 'success' if success else 'failed',
-                'error_msg': None if success else "Download failed",
-                'duration': current_item.get("duration", "N/A"),
-                'filename': f"{title}.{current_item['format']}" if title else "unknown_file", # Rough estimate
-                'file_size': 0 # We might need to get real file size if possible
-            }
-            
-            # Additional info from success
-            if success:
-                # We can try to get file size
-                try:
-                   fpath = os.path.join(DOWNLOAD_DIR, f"{title}.mp3" if current_item['format'] == 'mp3' else f"{title}.mp4")
-                   if os.path.exists(fpath):
-                       db_record['file_size'] = os.path.getsize(fpath)
-                       db_record['filename'] = os.path.basename(fpath)
-                except:
-                    pass
-            
-            save_to_db(db_record)
-        except Exception as e:
-            safe_print(f"[DB] Failed to save history: {e}")
-
-        # Small delay between downloads
-        time.sleep(1)
-    
-    is_downloading = False
-    socketio.emit("all_downloads_complete", {})
-    safe_print("\n[QUEUE] All downloads complete!")
+        save_to_db(db_record)
+    except Exception as e:
+        safe_print(f"[DB] Failed to save history: {e}")
 
 def download_single_item(item):
-    """Download a single queue item. Returns (success, title) tuple."""
+    """
+    Download a single queue item. Returns (success, title, postprocess_job); the job is
+    None when the file is final, otherwise it is run by run_postprocess.
+    """
     
     url = item["url"]
     fmt = item["format"]
@@ -722,45 +2629,40 @@ def download_single_item(item):
     item_id = item["id"]
     
     safe_print(f"\n[DOWNLOAD] Starting: {url}")
-    socketio.emit("status", {"msg": "Đang phân tích video...", "percent": "0%"})
+    socketio.emit("status", {"id": item_id, "msg": "Đang phân tích video...", "percent": "0%"})
+    
+    # Pace requests to the same platform
+    waited = rate_limiter.acquire_request(item.get("domain"))
+    if waited:
+        safe_print(f"[LIMITS] Waited {waited:.1f}s for {item.get('domain')}")
+    
+    last_bytes = {"value": 0}
+    transfer = {"bytes": 0, "seconds": 0}  # Network part only, for the throughput average
     
     def progress_hook(d):
         try:
             status = d.get("status")
-            # Debug: log every hook call
-            downloaded = d.get("downloaded_bytes", 0)
-            total = d.get("total_bytes") or d.get("total_bytes_estimate", 0)
-            safe_print(f"[HOOK] status={status}, downloaded={downloaded}, total={total}")
             
             if status == "downloading":
-                downloaded_bytes = d.get("downloaded_bytes", 0)
-                total_bytes = d.get("total_bytes") or d.get("total_bytes_estimate", 0)
+                downloaded_bytes = d.get("downloaded_bytes") or 0
+                total_bytes = d.get("total_bytes") or d.get("total_bytes_estimate") or 0
+                
+                # Global bandwidth cap (the counter restarts for each file of a merged format)
+                new_bytes = downloaded_bytes - last_bytes["value"]
+                if new_bytes < 0:
+                    new_bytes = downloaded_bytes
+                last_bytes["value"] = downloaded_bytes
+                rate_limiter.consume_bandwidth(new_bytes)
+                
+                # Only the latest value per item survives until the next batch flush
+                progress_aggregator.update(item_id, downloaded_bytes, total_bytes)
                 
-                if total_bytes > 0:
-                    percent = (downloaded_bytes / total_bytes) * 100
-                    percent_str = f"{percent:.1f}%"
-                    
-                    # Debug log
-                    safe_print(f"[PROGRESS] {percent_str}")
-                    
-                    # Update item progress
-                    with queue_lock:
-                        for queue_item in download_queue:
-                            if queue_item["id"] == item_id:
-                                queue_item["progress"] = percent_str
-                                break
-                    
-                    # Emit with msg field for frontend compatibility
-                    socketio.emit("progress", {
-                        "percent": percent_str, 
-                        "msg": f"Đang tải xuống... {percent_str}",
-                        "status": "downloading"
-                    })
-                    socketio.emit("queue_item_progress", {"id": item_id, "percent": percent_str})
-                    
             elif status == "finished":
+                if d.get("elapsed"):
+                    transfer["bytes"] += d.get("total_bytes") or d.get("downloaded_bytes") or 0
+                    transfer["seconds"] += d["elapsed"]
                 safe_print("[PROGRESS] 100% - Processing...")
-                socketio.emit("progress", {"percent": "100%", "msg": "Đang xử lý video...", "status": "processing"})
+                socketio.emit("progress", {"id": item_id, "percent": "100%", "msg": "Đang xử lý video...", "status": "processing"})
                 
         except Exception as e:
             safe_print(f"Progress hook error: {e}")
@@ -770,22 +2672,21 @@ def download_single_item(item):
         ydl_opts = {
             "format": "bestaudio/best",
             "outtmpl": f"{DOWNLOAD_DIR}/%(title)s.%(ext)s",
-            "postprocessors": [{
-                "key": "FFmpegExtractAudio",
-                "preferredcodec": "mp3",
-                "preferredquality": "320"
-            }],
             "progress_hooks": [progress_hook],
             "noplaylist": True,
             "quiet": False,
             "no_warnings": False,
-            "noprogress": False,
+            "noprogress": True,  # Progress is reported through progress_hook batches
+            "continuedl": True,  # Resume .part files left by an interrupted run
         }
     elif fmt == "mp4":
         # Logic adapted from original code to support quality selection
         safe_print(f"[DOWNLOAD] Quality preference: {quality}")
         
-        format_string = f"bestvideo[height<={quality.replace('p', '')}][ext=mp4]+bestaudio[ext=m4a]/best[height<={quality.replace('p', '')}]" if quality != "best" else "bestvideo[ext=mp4]+bestaudio[ext=m4a]/best"
+        # mp4/m4a streams merge without re-encoding; otherwise any codecs the mp4 container can hold
+        # (merged by stream copy too) before settling for a single progressive file
+        height = f"[height<={quality.replace('p', '')}]" if quality != "best" else ""
+        format_string = f"bestvideo{height}[ext=mp4]+bestaudio[ext=m4a]/bestvideo{height}+bestaudio/best{height}"
         
         ydl_opts = {
             "format": format_string,
@@ -795,11 +2696,8 @@ def download_single_item(item):
             "noplaylist": True,
             "quiet": False,
             "no_warnings": False,
-            "noprogress": False,
-             "postprocessors": [{
-                'key': 'FFmpegVideoConvertor',
-                'preferedformat': 'mp4',
-            }],
+            "noprogress": True,  # Progress is reported through progress_hook batches
+            "continuedl": True,  # Resume .part files left by an interrupted run
         }
     else:  # auto
         ydl_opts = {
@@ -810,37 +2708,41 @@ def download_single_item(item):
             "noplaylist": True,
             "quiet": False,
             "no_warnings": False,
-            "noprogress": False,
+            "noprogress": True,  # Progress is reported through progress_hook batches
+            "continuedl": True,  # Resume .part files left by an interrupted run
         }
 
+    ratelimit = item.get("ratelimit") or rate_limiter.per_download
+    if ratelimit:
+        ydl_opts["ratelimit"] = ratelimit
+    
+    tuning = tune_download(item)
+    ydl_opts.update(tuning)
+    safe_print(f"[DOWNLOAD] Fragments: {tuning['concurrent_fragment_downloads']}, "
+               f"chunk: {format_file_size(tuning['http_chunk_size'])}, buffer: {format_file_size(tuning['buffersize'])}")
+
     try:
         with yt_dlp.YoutubeDL(ydl_opts) as ydl:
             # Get video info first
-            socketio.emit("status", {"msg": "Đang lấy thông tin video...", "percent": "0%"})
+            socketio.emit("status", {"id": item_id, "msg": "Đang lấy thông tin video...", "percent": "0%"})
             
-            info = ydl.extract_info(url, download=False)
+            # Reuse info from the preview (or an earlier attempt) instead of extracting again
+            info = metadata_cache.get(url)
+            from_cache = info is not None
+            if not from_cache:
+                info = metadata_cache.put(url, run_blocking(ydl.extract_info, url, download=False))
             title = info.get('title', 'Unknown')
             duration = info.get('duration', 0)
             platform = info.get('extractor', 'Unknown')
             
             # Update item title and platform info
-            with queue_lock:
-                for queue_item in download_queue:
-                    if queue_item["id"] == item_id:
-                        queue_item["title"] = title
-                        queue_item["duration"] = f"{int(duration)//60}:{int(duration)%60:02d}" if duration else "N/A"
-                        queue_item["platform"] = platform
-                        break
-            
-            # Update item title
-            with queue_lock:
-                for queue_item in download_queue:
-                    if queue_item["id"] == item_id:
-                        queue_item["title"] = title
-                        break
-            
-            # Broadcast queue update with title
-            socketio.emit("queue_updated", {"queue": download_queue})
+            download_queue.update(item_id,
+                                  title=title,
+                                  duration=f"{int(duration)//60}:{int(duration)%60:02d}" if duration else "N/A",
+                                  platform=platform,
+                                  extractor=info.get("extractor_key") or platform,
+                                  video_id=info.get("id"),
+                                  thumbnail=info.get("thumbnail"))
             
             # Format duration
             if duration:
@@ -850,6 +2752,7 @@ def download_single_item(item):
                 duration_str = "N/A"
                 
             socketio.emit("info", {
+                "id": item_id,
                 "title": title,
                 "duration": duration_str,
                 "msg": f"Bắt đầu tải: {title}"
@@ -859,12 +2762,53 @@ def download_single_item(item):
             safe_print(f"Downloading: {title}")
             safe_print(f"{'='*60}\n")
             
+            # Same video in the same format was downloaded before and the file is still there
+            existing = find_downloaded_file(download_queue.get(item_id)) if DEDUPE_DOWNLOADS else None
+            if existing:
+                safe_print(f"[DEDUPE] {title} already downloaded: {existing}")
+                download_queue.update(item_id, filepath=existing, deduplicated=True)
+                socketio.emit("done", {"id": item_id, "msg": f"♻️ Đã có sẵn: {title}", "percent": "100%"})
+                return True, title, None
+            
             # Start download
-            socketio.emit("status", {"msg": "Đang tải xuống...", "percent": "0%"})
-            ydl.download([url])
+            socketio.emit("status", {"id": item_id, "msg": "Đang tải xuống...", "percent": "0%"})
+            try:
+                # Same path as yt-dlp --load-info-json: no third extraction
+                result = ydl.process_ie_result(copy.deepcopy(info), download=True)
+            except yt_dlp.utils.DownloadError:
+                if not from_cache:
+                    raise
+                # Format URLs in the cached info may have expired, extract fresh once
+                safe_print(f"[CACHE] Cached info failed for {url}, extracting again")
+                metadata_cache.invalidate(url)
+                info = metadata_cache.put(url, run_blocking(ydl.extract_info, url, download=False))
+                result = ydl.process_ie_result(copy.deepcopy(info), download=True)
             
+            # FFmpeg work is handed to the post-processing pool so this worker can start the next download
+            # (requested_downloads only keep the fields that differ from the video info)
+            downloads = result.get("requested_downloads") or []
+            job = None
+            if downloads:
+                pp_info = {key: value for key, value in result.items() if key != "requested_downloads"}
+                pp_info.update(downloads[0])
+                download_queue.update(item_id, filepath=pp_info.get("filepath"))
+                job = plan_postprocess(fmt, pp_info)
+                safe_print(f"[POSTPROCESS] {title}: {job['path']} ({pp_info.get('vcodec')}/{pp_info.get('acodec')} in .{pp_info.get('ext')})")
+                download_queue.update(item_id, pp_path=job["path"])
+                if job["path"] == "none":
+                    with queue_lock:
+                        stats["postprocess_paths"]["none"] += 1
+                    job = None
+            
+        record_throughput(item.get("domain"), transfer["bytes"], transfer["seconds"])
+        download_queue.update(item_id,
+                              transfer_bytes=transfer["bytes"],
+                              transfer_seconds=transfer["seconds"],
+                              throughput=transfer["bytes"] / transfer["seconds"] if transfer["seconds"] else None)
+        
         # Success
         socketio.emit("done", {
+            "id": item_id,
             "msg": f"✅ Đã tải xong: {title}",
             "percent": "100%"
         })
@@ -874,10 +2818,11 @@ def download_single_item(item):
         safe_print(f"Saved to: {os.path.abspath(DOWNLOAD_DIR)}")
         safe_print(f"{'='*60}\n")
         
-        return True, title
+        return True, title, job
         
     except Exception as e:
         error_msg = str(e)
+        error_kind = classify_download_error(error_msg)
         
         # Simplify common error messages
         if "Video unavailable" in error_msg:
@@ -891,10 +2836,13 @@ def download_single_item(item):
         elif "HTTP Error 404" in error_msg:
             error_msg = "Không tìm thấy video"
         
-        socketio.emit("error", {"msg": f"Lỗi: {error_msg}"})
+        # Kept on the item for the retry scheduler and the history record
+        download_queue.update(item_id, last_error=error_msg, error_kind=error_kind)
+        
+        socketio.emit("error", {"id": item_id, "msg": f"Lỗi: {error_msg}"})
         safe_print(f"\nError: {error_msg}\n")
         
-        return False, None
+        return False, None, None
 
 # ================== LEGACY SINGLE DOWNLOAD (keeping for compatibility) ==================
 @socketio.on("start_download")
@@ -948,8 +2896,17 @@ if __name__ == "__main__":
     safe_print(f"Download directory: {os.path.abspath(DOWNLOAD_DIR)}")
     safe_print(f"{'='*50}\n")
     
+    # Pick up the queue from the previous run
+    restore_queue()
+    if RESUME_QUEUE_ON_START and download_queue.count("pending"):
+        start_queue_download()
+    
     # Open browser automatically
     threading.Timer(0.5, open_browser, args=(port,)).start()
     
-    # Run server with threading
-    socketio.run(app, host="127.0.0.1", port=port, debug=False, allow_unsafe_werkzeug=True)
\ No newline at end of file
+    # Run server (Werkzeug with threads, or eventlet's WSGI server in eventlet mode)
+    safe_print(f"[SERVER] Async mode: {ASYNC_MODE}")
+    if ASYNC_MODE == "threading":
+        socketio.run(app, host="127.0.0.1", port=port, debug=False, allow_unsafe_werkzeug=True)
+    else:
+        socketio.run(app, host="127.0.0.1", port=port, debug=False)
\ No newline at end of file
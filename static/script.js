@@ -56,15 +56,21 @@ function startQueueDownload() {
 }
 
 // ================== State ==================
-let queue = [];
+const queueItems = new Map();  // id -> item, kept in sync by server deltas
+let queueSeq = 0;
+let resyncPending = false;
 let isDownloading = false;
-let allHistory = [];
 let currentFilter = 'all';
+let historyCursor = null;   // Cursor (or search offset) of the next history page, null = no more pages
+let historyLoading = false;
+let historyRequest = 0;     // Id of the latest history request, older responses are ignored
+let historySearch = '';
 
 // ================== DOM Elements ==================
 const urlInput = document.getElementById('url');
 const formatSelect = document.getElementById('format');
 const qualitySelect = document.getElementById('quality');
+const intakeModeSelect = document.getElementById('intakeMode');
 const addQueueBtn = document.getElementById('addQueueBtn');
 const downloadBtn = document.getElementById('downloadBtn');
 const btnText = document.getElementById('btnText');
@@ -89,11 +95,71 @@ socket.on('connected', (data) => {
 });
 
 // --- Queue Events ---
-socket.on('queue_updated', (data) => {
-    queue = data.queue;
+// The server sends a full snapshot on connect, then numbered deltas.
+// A gap in the sequence means we missed something, so we ask for a new snapshot.
+function acceptQueueSeq(seq) {
+    if (resyncPending || seq <= queueSeq) return false;
+    if (seq !== queueSeq + 1) {
+        resyncPending = true;
+        socket.emit('queue_resync');
+        return false;
+    }
+    queueSeq = seq;
+    return true;
+}
+
+socket.on('queue_snapshot', (data) => {
+    queueSeq = data.seq;
+    resyncPending = false;
+    queueItems.clear();
+    data.queue.forEach(item => queueItems.set(item.id, item));
     renderQueue();
 });
 
+socket.on('item_added', (data) => {
+    if (!acceptQueueSeq(data.seq)) return;
+    queueItems.set(data.item.id, data.item);
+    if (queueItems.size === 1) queueList.innerHTML = '';
+    queueList.appendChild(createQueueRow(data.item, 0));
+    updateQueueCount();
+});
+
+socket.on('item_changed', (data) => {
+    if (!acceptQueueSeq(data.seq)) return;
+    const item = queueItems.get(data.id);
+    if (!item) return;
+    Object.assign(item, data.changes);
+    if ('priority' in data.changes || 'order' in data.changes) {
+        renderQueue();  // Scheduling order changed
+    } else {
+        patchQueueRow(item);
+    }
+});
+
+socket.on('item_removed', (data) => {
+    if (!acceptQueueSeq(data.seq)) return;
+    queueItems.delete(data.id);
+    const row = queueList.querySelector(`[data-id="${data.id}"]`);
+    if (row) row.remove();
+    if (queueItems.size === 0) {
+        renderQueue();
+    } else {
+        updateQueueCount();
+    }
+});
+
+// Playlist entries stream into the queue while the server enumerates them
+socket.on('playlist_progress', (data) => {
+    const name = data.title || truncateUrl(data.url);
+    if (data.error) {
+        showToast(`❌ ${data.error}: ${name}`, 'error');
+    } else if (data.done) {
+        showToast(`📃 ${name}: đã thêm ${data.added} video (bỏ qua ${data.skipped})`, 'success');
+    } else {
+        statusText.textContent = `📃 Đang đọc ${name}: ${data.found} video...`;
+    }
+});
+
 socket.on('download_started', (data) => {
     isDownloading = true;
     updateButtons();
@@ -129,10 +195,30 @@ socket.on('progress', (data) => {
     }
 });
 
-socket.on('queue_item_progress', (data) => {
-    const item = document.querySelector(`[data-id="${data.id}"] .queue-item-progress`);
-    if (item) {
-        item.textContent = data.percent;
+// Batched progress (a few times per second) for every item that changed since the last batch
+socket.on('progress_batch', (data) => {
+    data.items.forEach(entry => {
+        const item = queueItems.get(entry.id);
+        if (item && item.status === 'downloading') {
+            Object.assign(item, entry);
+            patchQueueRow(item);
+        }
+    });
+
+    // Main progress bar shows the combined progress of all running downloads
+    let downloaded = 0, total = 0, speed = 0, eta = 0;
+    queueItems.forEach(item => {
+        if (item.status !== 'downloading' || !item.total_bytes) return;
+        downloaded += item.downloaded_bytes;
+        total += item.total_bytes;
+        speed += item.speed || 0;
+        eta = Math.max(eta, item.eta || 0);
+    });
+    if (total > 0) {
+        const percent = `${(downloaded / total * 100).toFixed(1)}%`;
+        percentText.textContent = percent;
+        progressBar.style.width = percent;
+        statusText.textContent = `Đang tải xuống... ${formatSpeed(speed)}${eta ? ` • còn ${formatEta(eta)}` : ''}`;
     }
 });
 
@@ -148,7 +234,7 @@ socket.on('done', (data) => {
     setTimeout(updateHistoryBadge, 1000);
 
     setTimeout(() => {
-        if (queue.filter(q => q.status === 'pending').length === 0) {
+        if ([...queueItems.values()].every(q => q.status !== 'pending')) {
             isDownloading = false;
             updateButtons();
             downloadBtn.classList.remove('downloading');
@@ -226,7 +312,8 @@ function addToQueue() {
     socket.emit('add_to_queue', {
         urls: urls,
         format: format,
-        quality: quality
+        quality: quality,
+        playlist: intakeModeSelect.value === 'playlist'
     });
 
     // Clear input with animation
@@ -245,7 +332,7 @@ function removeFromQueue(id) {
 }
 
 function clearQueue() {
-    if (queue.length === 0) return;
+    if (queueItems.size === 0) return;
     if (confirm('🗑️ Bạn có chắc muốn xóa tất cả video khỏi hàng đợi?')) {
         socket.emit('clear_queue');
         showToast('🗑️ Đã xóa tất cả video khỏi hàng đợi', 'info');
@@ -253,14 +340,16 @@ function clearQueue() {
 }
 
 function startDownload() {
-    if (queue.length === 0) {
+    if (queueItems.size === 0) {
         const text = urlInput.value.trim();
         if (text) {
             const urls = parseUrls(text);
             if (urls.length > 0) {
                 const format = formatSelect.value;
                 const quality = qualitySelect.value;
-                socket.emit('add_to_queue', { urls: urls, format: format, quality: quality });
+                socket.emit('add_to_queue', {
+                    urls: urls, format: format, quality: quality, playlist: intakeModeSelect.value === 'playlist'
+                });
                 urlInput.value = '';
                 setTimeout(() => {
                     socket.emit('start_queue_download');
@@ -275,10 +364,10 @@ function startDownload() {
     socket.emit('start_queue_download');
 }
 
-function renderQueue() {
+function updateQueueCount() {
     // Animate count change
     const oldCount = parseInt(queueCount.textContent);
-    const newCount = queue.length;
+    const newCount = queueItems.size;
 
     if (oldCount !== newCount) {
         queueCount.style.animation = 'none';
@@ -290,8 +379,12 @@ function renderQueue() {
     queueCount.textContent = newCount.toString();
     const queueBadge = document.getElementById('queueBadge');
     if (queueBadge) queueBadge.textContent = newCount.toString();
+}
+
+function renderQueue() {
+    updateQueueCount();
 
-    if (queue.length === 0) {
+    if (queueItems.size === 0) {
         queueList.innerHTML = `
             <div class="queue-empty">
                 <div class="queue-empty-icon">📭</div>
@@ -302,19 +395,72 @@ function renderQueue() {
         return;
     }
 
-    queueList.innerHTML = queue.map((item, index) => `
-        <div class="queue-item ${item.status}" data-id="${item.id}" style="animation-delay: ${index * 0.05}s">
-            <div class="queue-item-status"></div>
-            <div class="queue-item-info">
-                <div class="queue-item-title">${item.title || 'Đang lấy thông tin...'}</div>
-                <div class="queue-item-url">${truncateUrl(item.url)}</div>
-            </div>
-            <div class="queue-item-progress">${item.progress || ''}</div>
-            ${item.status === 'pending' ? `
-                <button class="queue-item-remove" onclick="removeFromQueue('${item.id}')" title="Xóa khỏi hàng đợi">×</button>
-            ` : ''}
+    queueList.innerHTML = '';
+    [...queueItems.values()].sort(compareQueueItems).forEach((item, index) => {
+        queueList.appendChild(createQueueRow(item, index));
+    });
+}
+
+// Approximates the server scheduler: priority, then items moved to the front, then FIFO
+function compareQueueItems(a, b) {
+    return (b.priority || 0) - (a.priority || 0)
+        || Number(!!b.pinned) - Number(!!a.pinned)
+        || (a.order || 0) - (b.order || 0);
+}
+
+function moveToFront(id) {
+    socket.emit('move_to_front', { id: id });
+}
+
+function createQueueRow(item, index) {
+    const row = document.createElement('div');
+    row.dataset.id = item.id;
+    row.style.animationDelay = `${index * 0.05}s`;
+    row.innerHTML = `
+        <div class="queue-item-status"></div>
+        <div class="queue-item-info">
+            <div class="queue-item-title"></div>
+            <div class="queue-item-url">${truncateUrl(item.url)}</div>
         </div>
-    `).join('');
+        <div class="queue-item-progress"></div>
+        <button class="queue-item-remove queue-item-front" onclick="moveToFront('${item.id}')" title="Tải tiếp theo">⏫</button>
+        <button class="queue-item-remove" onclick="removeFromQueue('${item.id}')" title="Xóa khỏi hàng đợi">×</button>
+    `;
+    patchQueueRow(item, row);
+    return row;
+}
+
+// Update only the parts of a row that depend on mutable item fields
+function patchQueueRow(item, row = queueList.querySelector(`[data-id="${item.id}"]`)) {
+    if (!row) return;
+    row.className = `queue-item ${item.status}`;
+    row.querySelector('.queue-item-title').textContent = `${item.priority > 0 ? '⚡ ' : ''}${item.title || 'Đang lấy thông tin...'}`;
+    let progress = item.status === 'downloading' && item.speed
+        ? `${item.progress} • ${formatSpeed(item.speed)}`
+        : (item.progress || '');
+    if (item.status === 'downloading' && item.attempts > 1) {
+        progress += ` • lần ${item.attempts}`;
+    }
+    row.querySelector('.queue-item-progress').textContent = progress;
+    row.querySelectorAll('.queue-item-remove').forEach(button => {
+        button.style.display = item.status === 'pending' ? '' : 'none';
+    });
+}
+
+function formatSpeed(bytesPerSecond) {
+    const units = ['B/s', 'KB/s', 'MB/s', 'GB/s'];
+    let value = bytesPerSecond || 0;
+    let unit = 0;
+    while (value >= 1024 && unit < units.length - 1) {
+        value /= 1024;
+        unit++;
+    }
+    return `${value.toFixed(1)} ${units[unit]}`;
+}
+
+function formatEta(seconds) {
+    const minutes = Math.floor(seconds / 60);
+    return `${minutes}:${String(seconds % 60).padStart(2, '0')}`;
 }
 
 function truncateUrl(url) {
@@ -326,7 +472,7 @@ function truncateUrl(url) {
 
 function updateButtons() {
     downloadBtn.disabled = isDownloading;
-    addQueueBtn.disabled = isDownloading;
+    // Adding to the queue stays enabled: running workers pick up new items
 
     if (isDownloading) {
         btnText.innerHTML = `<span class="loading-dots"><span></span><span></span><span></span></span> ĐANG TẢI`;
@@ -338,6 +484,7 @@ function updateButtons() {
 // ================== Preview Functions ==================
 let pendingPreviews = 0;
 let previewResults = [];
+let previewBatch = 0;  // Results of older batches are stale and ignored (the server skips them too)
 
 function previewVideo() {
     const urls = parseUrls(urlInput.value.trim());
@@ -354,23 +501,31 @@ function previewVideo() {
 
     previewResults = [];
     pendingPreviews = urls.length;
+    previewBatch++;
     previewList.innerHTML = '<div class="preview-loading">🔍 Đang lấy thông tin ' + urls.length + ' video...</div>';
     previewContainer.style.display = 'block';
     previewCount.textContent = `0/${urls.length} video`;
 
-    // Fetch info for ALL URLs
-    urls.forEach((url, index) => {
-        socket.emit("get_video_info", { url, index });
-    });
+    // Fetch info for ALL URLs (one event, results come back per URL with their index)
+    socket.emit("get_video_info_batch", { urls, batch: previewBatch });
 
     showToast(`🔍 Đang lấy thông tin ${urls.length} video...`, 'info');
 }
 
+// The server checks thumbnails after sending the preview and reports broken ones
+socket.on('thumbnail_invalid', (data) => {
+    if (data.batch !== previewBatch) return;
+    const img = document.querySelector(`.video-preview-card[data-index="${data.index}"] .preview-thumbnail`);
+    if (img) img.outerHTML = '<div class="preview-thumbnail-placeholder">🎬</div>';
+});
+
 function displayVideoPreview(data) {
     const previewContainer = document.getElementById('videoPreviewContainer');
     const previewList = document.getElementById('videoPreviewList');
     const previewCount = document.getElementById('previewCount');
 
+    if (data.batch !== previewBatch) return;
+
     // Store the result
     previewResults.push(data);
     pendingPreviews--;
@@ -383,6 +538,7 @@ function displayVideoPreview(data) {
     // Create a preview card for this video
     const card = document.createElement('div');
     card.className = 'video-preview-card';
+    card.dataset.index = data.index;
 
     const thumbnailHtml = data.thumbnail
         ? `<img src="${data.thumbnail}" alt="Thumbnail" class="preview-thumbnail" onerror="this.style.display='none'">`
@@ -422,6 +578,7 @@ function closeAllPreviews() {
     previewContainer.style.display = 'none';
     previewResults = [];
     pendingPreviews = 0;
+    previewBatch++;
 }
 
 
@@ -449,32 +606,56 @@ function switchTab(tabName) {
     }
 }
 
-async function loadHistory() {
+// Server-side filters matching the active filter pill
+function historyParams() {
+    const params = new URLSearchParams();
+    if (currentFilter === 'success' || currentFilter === 'failed') params.set('status', currentFilter);
+    if (currentFilter === 'mp4' || currentFilter === 'mp3') params.set('format', currentFilter);
+    return params;
+}
+
+// Loads the first page (or the next one when appending) of either the plain history or the search results
+async function loadHistory(append = false) {
     const historyList = document.getElementById('historyList');
-    historyList.innerHTML = '<div class="loading">⏳ Đang tải lịch sử...</div>';
+    if (append && (historyLoading || historyCursor === null)) return;
+    const requestId = ++historyRequest;
+    historyLoading = true;
+
+    if (!append) {
+        historyCursor = null;
+        historyList.innerHTML = '<div class="loading">⏳ Đang tải lịch sử...</div>';
+    }
 
     try {
-        const response = await fetch('/api/history');
-        allHistory = await response.json();
+        const params = historyParams();
+        if (historySearch) params.set('q', historySearch);
+        if (append) params.set(historySearch ? 'offset' : 'cursor', historyCursor);
+        const endpoint = historySearch ? '/api/search-history' : '/api/history';
+        const response = await fetch(`${endpoint}?${params}`);
+        const data = await response.json();
+        if (requestId !== historyRequest) return;
 
-        updateHistoryBadge();
-        displayHistory(allHistory);
+        historyCursor = historySearch ? data.next_offset : data.next_cursor;
+        displayHistory(data.history, append);
+        if (!append && !historySearch) updateHistoryBadge();
 
     } catch (error) {
         historyList.innerHTML = '<div class="loading">❌ Lỗi khi tải lịch sử</div>';
         console.error('Error loading history:', error);
+    } finally {
+        if (requestId === historyRequest) historyLoading = false;
     }
 }
 
-function displayHistory(history) {
+function displayHistory(history, append = false) {
     const historyList = document.getElementById('historyList');
 
-    if (history.length === 0) {
+    if (!append && history.length === 0) {
         historyList.innerHTML = '<div class="loading">📭 Chưa có lịch sử tải xuống</div>';
         return;
     }
 
-    historyList.innerHTML = '';
+    if (!append) historyList.innerHTML = '';
 
     history.forEach(item => {
         const itemDiv = document.createElement('div');
@@ -483,7 +664,9 @@ function displayHistory(history) {
         const statusIcon = item.status === 'success' ? '✅' : '❌';
 
         itemDiv.innerHTML = `
-            <div class="history-icon">${item.platform_icon}</div>
+            ${item.thumbnail
+                ? `<img src="${item.thumbnail}" alt="" class="history-thumbnail" loading="lazy" onerror="this.style.display='none'">`
+                : `<div class="history-icon">${item.platform_icon}</div>`}
             <div class="history-info">
                 <h3>${statusIcon} ${item.title || 'Unknown'}</h3>
                 <div class="history-meta">
@@ -491,6 +674,8 @@ function displayHistory(history) {
                     <span>📦 ${item.format || 'N/A'}</span>
                     <span>💾 ${item.file_size}</span>
                     <span>⏱️ ${item.duration || 'N/A'}</span>
+                    ${item.attempts > 1 ? `<span>🔁 ${item.attempts} lần</span>` : ''}
+                    ${item.throughput ? `<span>⚡ ${formatSpeed(item.throughput)}</span>` : ''}
                 </div>
                 <div class="history-date">
                     📅 ${new Date(item.download_date).toLocaleString('vi-VN')}
@@ -509,16 +694,23 @@ function displayHistory(history) {
 
 async function updateHistoryBadge() {
     try {
-        const response = await fetch('/api/history');
-        const history = await response.json();
-        allHistory = history;
+        const response = await fetch('/api/history?limit=100');
+        const data = await response.json();
         const badge = document.getElementById('historyBadge');
         if (badge) {
-            badge.textContent = history.length;
+            badge.textContent = `${data.history.length}${data.next_cursor ? '+' : ''}`;
         }
     } catch (e) { console.log("Badge update failed", e); }
 }
 
+// Load the next page when the end of the history list scrolls into view
+const historyObserver = new IntersectionObserver((entries) => {
+    if (entries[0].isIntersecting) {
+        loadHistory(true);
+    }
+}, { rootMargin: '200px' });
+historyObserver.observe(document.getElementById('historySentinel'));
+
 async function copyUrl(url) {
     try {
         await navigator.clipboard.writeText(url);
@@ -554,67 +746,46 @@ async function clearHistoryRecord() {
 
 // ================== Search & Filter for History ==================
 let searchTimeout;
-async function searchHistory(query) {
+function searchHistory(query) {
     clearTimeout(searchTimeout);
+    historySearch = query.trim();
 
-    if (!query.trim()) {
-        displayHistory(allHistory);
+    if (!historySearch) {
+        loadHistory();
         return;
     }
 
-    searchTimeout = setTimeout(async () => {
-        try {
-            const response = await fetch(`/api/search-history?q=${encodeURIComponent(query)}`);
-            const results = await response.json();
-            displayHistory(results);
-        } catch (error) {
-            console.error('Search error:', error);
-        }
-    }, 300);
+    searchTimeout = setTimeout(() => loadHistory(), 300);
 }
 
 function filterHistory(filter) {
     currentFilter = filter;
 
-    document.querySelectorAll('.filter-btn').forEach(btn => {
+    document.querySelectorAll('.filter-pill').forEach(btn => {
         btn.classList.remove('active');
     });
     event.target.classList.add('active');
 
-    let filtered = allHistory;
-
-    if (filter === 'success') {
-        filtered = allHistory.filter(item => item.status === 'success');
-    } else if (filter === 'failed') {
-        filtered = allHistory.filter(item => item.status === 'failed');
-    } else if (filter === 'mp4') {
-        filtered = allHistory.filter(item => item.format === 'mp4');
-    } else if (filter === 'mp3') {
-        filtered = allHistory.filter(item => item.format === 'mp3');
-    }
-
-    displayHistory(filtered);
+    // Filtering happens on the server so it covers the whole history, not just the loaded page
+    loadHistory();
 }
 
-async function exportHistory() {
-    try {
-        const response = await fetch('/api/export-history');
-        const data = await response.json();
-
-        const blob = new Blob([JSON.stringify(data, null, 2)], { type: 'application/json' });
-        const url = URL.createObjectURL(blob);
-        const a = document.createElement('a');
-        a.href = url;
-        a.download = `download-history-${new Date().toISOString().split('T')[0]}.json`;
-        document.body.appendChild(a);
-        a.click();
-        document.body.removeChild(a);
-        URL.revokeObjectURL(url);
-
-        showToast('✅ Đã export lịch sử thành công!', 'success');
-    } catch (error) {
-        showToast('❌ Lỗi khi export', 'error');
-    }
+function exportHistory(format = 'json') {
+    // The server streams the file, the browser saves it directly without buffering it here
+    const params = historyParams();
+    // `format` is the file type of the export, the MP4/MP3 pill goes in `media_format`
+    if (params.has('format')) {
+        params.set('media_format', params.get('format'));
+    }
+    params.set('format', format);
+    const a = document.createElement('a');
+    a.href = `/api/export-history?${params}`;
+    a.download = '';
+    document.body.appendChild(a);
+    a.click();
+    document.body.removeChild(a);
+
+    showToast('✅ Đang export lịch sử...', 'success');
 }
 
 // ================== Toast Notifications ==================